@@ -0,0 +1,403 @@
+from contextlib import contextmanager
+import argparse
+import datetime
+import io
+import json
+import subprocess
+import threading
+import time
+import numpy as np
+import pandas as pd
+from garminconnect import GarminConnectTooManyRequestsError
+from influxdb_client.client.flux_csv_parser import FluxCsvParser, FluxSerializationMode
+import os
+import tempfile
+import catalog
+import fetcher
+import garmin as garmin
+import influxBackup as influxBackup
+import main
+import metrics
+import pipeline
+import query
+import query_cache
+import response_cache
+import storage
+
+# every run of bench_end_to_end is appended to this file so that regressions show up against earlier runs
+RESULTS_FILE = os.environ.get("garmin_benchmark_results", "benchmark_results.jsonl")
+# history lengths measured by bench_end_to_end (years)
+YEARS = [1, 5, 10]
+
+
+def synthetic_heart_rates(date, interval=120, gap_rate=0.05, seed=0):
+    """
+    Build a get_heart_rates response for date with one sample every interval seconds,
+    a fraction gap_rate of the samples have no value like when the watch is not worn
+    """
+    rng = np.random.default_rng(seed)
+    start = int(datetime.datetime.combine(date, datetime.time()).timestamp() * 1000)
+    samples = []
+    for i in range(24 * 60 * 60 // interval):
+        value = None if rng.random() < gap_rate else int(rng.integers(45, 180))
+        samples.append([start + i * interval * 1000, value])
+    return {
+        "calendarDate": date.isoformat(),
+        "restingHeartRate": 50,
+        "lastSevenDaysAvgRestingHeartRate": 51,
+        "heartRateValues": samples,
+    }
+
+class RateLimitedResponse:
+    # what fetcher.retry_after reads from a 429
+    status_code = 429
+
+    def __init__(self, retry_after):
+        self.headers = {"Retry-After": str(retry_after)}
+
+class FakeGarminClient:
+    """
+    Offline stand-in for garminconnect.Garmin answering the endpoints used by the collectors
+    of garmin.py with synthetic payloads. Every request sleeps for latency seconds and a
+    fraction rate_limit_rate of them fails with a 429 asking to retry after retry_after seconds.
+    """
+    garmin_connect_activities = "/activitylist-service/activities/search/activities"
+
+    def __init__(self, latency=0.02, rate_limit_rate=0.0, retry_after=0.05, interval=120, seed=0):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.interval = interval
+        self.rng = np.random.default_rng(seed)
+        self.requests = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+
+    def _request(self):
+        with self.lock:
+            self.requests += 1
+            limited = self.rng.random() < self.rate_limit_rate
+            if limited:
+                self.rate_limited += 1
+        time.sleep(self.latency)
+        if limited:
+            err = GarminConnectTooManyRequestsError("Too many requests")
+            err.response = RateLimitedResponse(self.retry_after)
+            raise err
+
+    def get_heart_rates(self, cdate):
+        self._request()
+        date = datetime.date.fromisoformat(cdate)
+        return synthetic_heart_rates(date, interval=self.interval, seed=date.toordinal())
+
+    def get_hrv_data(self, cdate):
+        self._request()
+        baseline = {"lowUpper": 40, "balancedLow": 45, "balancedUpper": 60, "markerValue": 0.5}
+        return {"hrvSummary": {"calendarDate": cdate, "weeklyAvg": 52, "lastNightAvg": 50, "lastNight5MinHigh": 70,
+                               "baseline": baseline, "status": "BALANCED"}}
+
+    def get_sleep_data(self, cdate):
+        self._request()
+        start = int(datetime.datetime.fromisoformat(cdate).timestamp() * 1000) - 2 * 60 * 60 * 1000
+        return {"dailySleepDTO": {
+            "calendarDate": cdate, "sleepTimeSeconds": 27000, "sleepStartTimestampLocal": start,
+            "sleepEndTimestampLocal": start + 27000 * 1000, "deepSleepSeconds": 5400, "lightSleepSeconds": 14400,
+            "remSleepSeconds": 5400, "awakeSleepSeconds": 1800, "averageSpO2Value": 95, "lowestSpO2Value": 88,
+            "highestSpO2Value": 99, "averageSpO2HRSleep": 52, "averageRespirationValue": 14, "lowestRespirationValue": 10,
+            "highestRespirationValue": 18, "awakeCount": 2, "avgSleepStress": 15,
+            "sleepScores": {"overall": {"value": 80}, "remPercentage": {"value": 20}, "lightPercentage": {"value": 53},
+                            "deepPercentage": {"value": 20}}}}
+
+    def get_weigh_ins(self, startdate, enddate):
+        self._request()
+        days = pd.date_range(startdate, enddate)
+        # a weigh-in every few days
+        return {"dailyWeightSummaries": [{"summaryDate": day.date().isoformat(), "latestWeight": {"weight": 64000.0 + i * 10}}
+                                         for i, day in enumerate(days) if i % 3 == 0]}
+
+    def get_max_metrics(self, cdate):
+        self._request()
+        return [{"generic": {"calendarDate": cdate, "vo2MaxPreciseValue": 52.3}}]
+
+    def get_blood_pressure(self, startdate, enddate):
+        self._request()
+        return {"measurementSummaries": []}
+
+    def connectapi(self, path, params=None):
+        self._request()
+        if path == self.garmin_connect_activities:
+            return []
+        return {"userData": {"gender": "MALE", "weight": 64000.0, "height": 170.0, "birthDate": "1990-01-01", "handedness": "RIGHT"}}
+
+def timeit(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+def bench_hr_conversion(days=30, repeat=5):
+    """
+    Compare the per-sample dictionary conversion of heart rate data with the columnar one,
+    both up to the line protocol sent to InfluxDB
+    """
+    responses = [synthetic_heart_rates(datetime.date(2023, 1, 1) + datetime.timedelta(days=i), interval=15, seed=i) for i in range(days)]
+    samples = sum(len(response["heartRateValues"]) for response in responses)
+
+    def dictionaries():
+        return [influxBackup.toLineProtocol(point) for response in responses for point in garmin.garmin_hr_to_hr_schema(response)]
+    def columnar():
+        return [line for response in responses for line in garmin.garmin_hr_to_hr_line_protocol(response)]
+    def arrays():
+        return [garmin.garmin_hr_to_hr_arrays(response) for response in responses]
+
+    # the columnar path must write exactly the same points
+    assert [line for line in dictionaries() if line] == columnar()
+
+    print(f"Heart rate conversion, {days} days, {samples} samples")
+    baseline = timeit(dictionaries, repeat)
+    for name, function in [("garmin_hr_to_hr_schema + toLineProtocol", dictionaries),
+                           ("garmin_hr_to_hr_line_protocol", columnar),
+                           ("garmin_hr_to_hr_arrays", arrays)]:
+        elapsed = baseline if function is dictionaries else timeit(function, repeat)
+        print(f"  {name:<42} {elapsed:8.3f}s {samples / elapsed:12.0f} samples/sec  x{baseline / elapsed:.1f}")
+
+def synthetic_times(rows, interval=120):
+    start = pd.Timestamp("2020-01-01", tz="UTC")
+    return pd.date_range(start, periods=rows, freq=f"{interval}s").strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def annotated_csv(rows, field="heartRateValue", measurement="RealTimeHeartRate"):
+    """
+    Annotated CSV as returned by InfluxDB for the unpivoted query of influxBackup.get
+    """
+    times = synthetic_times(rows)
+    values = np.random.default_rng(0).integers(45, 180, rows)
+    lines = [
+        "#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,long,string,string,string",
+        "#group,false,false,true,true,false,false,true,true,true",
+        "#default,_result,,,,,,,,",
+        ",result,table,_start,_stop,_time,_value,_field,_measurement,unit",
+    ]
+    lines += [f",,0,{times[0]},{times[-1]},{t},{v},{field},{measurement},bpm" for t, v in zip(times, values.tolist())]
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+def pivoted_csv(rows, field="heartRateValue"):
+    """
+    Plain CSV as returned by InfluxDB for query.buildQuery
+    """
+    times = synthetic_times(rows)
+    values = np.random.default_rng(0).integers(45, 180, rows)
+    lines = [f",result,table,_time,{field}"]
+    lines += [f",_result,0,{t},{v}" for t, v in zip(times, values.tolist())]
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+def legacy_populate_df(tables):
+    # the record loop populate_df used before query.py
+    data = {}
+    timestamps = {}
+    for table in tables:
+        sub_data = []
+        sub_timestamps = []
+        field = table.records[0].values["_field"]
+        for record in table.records:
+            sub_data.append(record.values["_value"])
+            sub_timestamps.append(record.values["_time"])
+        data[field] = sub_data
+        timestamps[field] = sub_timestamps
+    dfs = []
+    for field in data:
+        df = pd.DataFrame({"time": timestamps[field], field: data[field]})
+        df["time"] = pd.to_datetime(df["time"])
+        df = df.set_index("time")
+        df = df.sort_index()
+        dfs.append(df)
+    return dfs
+
+def bench_query_to_dataframe(rows=1_000_000, repeat=3):
+    """
+    Compare parsing a query result into DataFrames with the record loop and with query.readCsv,
+    both starting from the bytes InfluxDB sends back
+    """
+    annotated = annotated_csv(rows)
+    pivoted = pivoted_csv(rows)
+
+    def loop():
+        parser = FluxCsvParser(io.BytesIO(annotated), FluxSerializationMode.tables)
+        list(parser.generator())
+        return legacy_populate_df(parser.tables)
+    def vectorized():
+        return query.splitFields(query.readCsv(io.BytesIO(pivoted)))
+
+    print(f"Query result to DataFrame, {rows} rows")
+    start_time = time.perf_counter()
+    expected = loop()[0]
+    baseline = time.perf_counter() - start_time
+    elapsed = timeit(vectorized, repeat)
+    result = vectorized()[0]
+    assert (expected.index.asi8 == result.index.asi8).all() and (expected["heartRateValue"].values == result["heartRateValue"].values).all()
+    print(f"  {'FluxRecord loop':<42} {baseline:8.3f}s {rows / baseline:12.0f} rows/sec  x1.0")
+    print(f"  {'query.readCsv':<42} {elapsed:8.3f}s {rows / elapsed:12.0f} rows/sec  x{baseline / elapsed:.1f}")
+
+def benchmark_backends(directory):
+    """
+    Backends compared by bench_backends: an SQLite file in directory, and InfluxDB
+    in a temporary bucket when a server answers
+    """
+    backends = [storage.SQLiteBackend(os.path.join(directory, "benchmark.sqlite"))]
+    client = influxBackup.getInfuxClient()
+    try:
+        reachable = client.ping()
+    except Exception:
+        reachable = False
+    if reachable:
+        bucket = "garmin_benchmark"
+        buckets_api = client.buckets_api()
+        if buckets_api.find_bucket_by_name(bucket) is None:
+            buckets_api.create_bucket(bucket_name=bucket, org=influxBackup.org)
+        backends.append(storage.InfluxBackend(client, bucket=bucket))
+    else:
+        print("InfluxDB is not reachable, only the embedded backends are measured")
+        client.close()
+    return backends
+
+@contextmanager
+def _isolatedCache(directory):
+    # the writes of a benchmark mark its measurements as written, with the markers of the checkout
+    # that would drop the cached dashboard results of recent ranges, so every directory the runs
+    # write to is moved under directory
+    directories = [(response_cache, "CACHE_DIR", directory), (query_cache, "CACHE_DIR", os.path.join(directory, "queries")),
+                   (query_cache, "WRITES_DIR", os.path.join(directory, "writes")), (catalog, "CATALOG_DIR", directory),
+                   (metrics, "REPORT_DIR", os.path.join(directory, "reports"))]
+    saved = [getattr(module, name) for module, name, _ in directories]
+    for module, name, path in directories:
+        setattr(module, name, path)
+    try:
+        yield
+    finally:
+        for (module, name, _), path in zip(directories, saved):
+            setattr(module, name, path)
+
+def bench_backends(days=365, repeat=3, backends=None):
+    """
+    Compare the write throughput and the range query throughput of the storage backends
+    on a year of intraday heart rate
+    """
+    lines = [garmin.garmin_hr_to_hr_line_protocol(synthetic_heart_rates(datetime.date(2023, 1, 1) + datetime.timedelta(days=i), seed=i)) for i in range(days)]
+    points = sum(len(chunk) for chunk in lines)
+    start, stop = datetime.date(2023, 1, 1), datetime.date(2023, 1, 1) + datetime.timedelta(days=days + 1)
+    month = (datetime.date(2023, 6, 1), datetime.date(2023, 7, 1))
+    with tempfile.TemporaryDirectory() as directory, _isolatedCache(directory):
+        backends = backends or benchmark_backends(directory)
+        print(f"Storage backends, {days} days, {points} heart rate points")
+        print(f"  {'backend':<10}{'write':>14}{'full range':>14}{'one month':>14}{'budgeted':>14}  (points/sec, rows/sec, seconds, seconds)")
+        for backend in backends:
+            start_time = time.perf_counter()
+            backend.backupData(iter(lines))
+            write = points / (time.perf_counter() - start_time)
+            rows = len(backend.get(["RealTimeHeartRate"], ["heartRateValue"], start, stop))
+            full = rows / timeit(lambda: backend.get(["RealTimeHeartRate"], ["heartRateValue"], start, stop), repeat)
+            one_month = timeit(lambda: backend.get(["RealTimeHeartRate"], ["heartRateValue"], *month), repeat)
+            budgeted = timeit(lambda: backend.populate_df(["RealTimeHeartRate"], ["heartRateValue"], start, stop, points=query.POINT_BUDGET), repeat)
+            print(f"  {backend.name:<10}{write:>14.0f}{full:>14.0f}{one_month:>14.3f}{budgeted:>14.3f}")
+            if backend.name == "influx":
+                backend.client.buckets_api().delete_bucket(backend.client.buckets_api().find_bucket_by_name(backend.bucket))
+            backend.close()
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def saveResult(result, path=RESULTS_FILE):
+    """
+    Append a result to the results file and print how it compares with the previous run of the same benchmark
+    """
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["benchmark"] == result["benchmark"] and entry["parameters"] == result["parameters"]:
+                    previous = entry
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(result) + "\n")
+    if previous is not None:
+        for metric, value in result["metrics"].items():
+            before = previous["metrics"].get(metric)
+            if before:
+                print(f"  {metric:<28}{value:>14.3f}  was {before:.3f} at {previous['commit']} ({value / before - 1:+.0%})")
+
+def bench_end_to_end(years=1, latency=0.02, rate_limit_rate=0.01, interval=120, results=RESULTS_FILE):
+    """
+    Run every stage of main.py against FakeGarminClient into an SQLite file standing in for
+    InfluxDB, then time the dashboard queries over the whole history
+
+    Args:
+        years: length of the history backed up
+        latency: seconds taken by every fake Garmin request
+        rate_limit_rate: fraction of the requests answered with a 429
+        interval: seconds between two intraday heart rate samples
+        results: file the result is appended to, None to not store it
+    Returns:
+        result: dictionary of the parameters and the measured metrics
+    """
+    stop_date = datetime.date(2024, 12, 31)
+    start_date = stop_date - datetime.timedelta(days=365 * years - 1)
+    client = FakeGarminClient(latency=latency, rate_limit_rate=rate_limit_rate, interval=interval)
+    # the budget of the real runs would make the benchmark measure the limiter only
+    limiter = fetcher.RateLimiter(rate=1e6, burst=1e6)
+    print(f"End to end, {years} years, {latency * 1000:.0f}ms per request, {rate_limit_rate:.0%} rate limited")
+    with tempfile.TemporaryDirectory() as directory, _isolatedCache(directory):
+        backend = storage.SQLiteBackend(os.path.join(directory, "benchmark.sqlite"))
+        try:
+            stages = main.buildStages(client, start_date, stop_date, {}, 0, None)
+            start_time = time.perf_counter()
+            stages = pipeline.run_stages(stages, backend, limiter=limiter, write=lambda backend, data: backend.backupData(data))
+            ingest = time.perf_counter() - start_time
+            failed = [stage.name for stage in stages if stage.error is not None]
+            if failed:
+                raise RuntimeError(f"Stages {', '.join(failed)} failed")
+            points = sum(stage.points for stage in stages)
+            full = timeit(lambda: backend.populate_df(["RealTimeHeartRate"], ["heartRateValue"], start_date, stop_date, points=query.POINT_BUDGET), 3)
+            raw_start = stop_date - datetime.timedelta(days=7)
+            week = timeit(lambda: backend.populate_df(["RealTimeHeartRate"], ["heartRateValue"], raw_start, stop_date), 3)
+        finally:
+            backend.close()
+    result = {
+        "benchmark": "end_to_end",
+        "commit": _commit(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "parameters": {"years": years, "latency": latency, "rate_limit_rate": rate_limit_rate, "interval": interval, "workers": fetcher.WORKERS},
+        "metrics": {
+            "ingest_seconds": ingest,
+            "points_per_second": points / ingest,
+            "requests_per_second": client.requests / ingest,
+            "dashboard_full_range_seconds": full,
+            "dashboard_week_seconds": week,
+        },
+        "counts": {"points": points, "requests": client.requests, "rate_limited": client.rate_limited},
+    }
+    print(f"  {points} points from {client.requests} requests ({client.rate_limited} rate limited) in {ingest:.1f}s, "
+          f"{points / ingest:.0f} points/sec")
+    print(f"  dashboard: whole history {full:.3f}s, last week raw {week:.3f}s")
+    if results is not None:
+        saveResult(result, results)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the backup and of the dashboard queries")
+    parser.add_argument("--end-to-end", action="store_true", help="only run the end to end benchmark")
+    parser.add_argument("--years", type=int, nargs="+", default=YEARS, help="history lengths of the end to end benchmark")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds taken by every fake Garmin request")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.01, help="fraction of the fake Garmin requests answered with a 429")
+    args = parser.parse_args()
+    if not args.end_to_end:
+        bench_hr_conversion()
+        bench_query_to_dataframe()
+        bench_backends()
+    for years in args.years:
+        bench_end_to_end(years, latency=args.latency, rate_limit_rate=args.rate_limit_rate)
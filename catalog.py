@@ -0,0 +1,62 @@
+import json
+import os
+import threading
+import time
+import response_cache
+
+# where the measurement catalogs are stored, one file per storage backend
+CATALOG_DIR = os.environ.get("garmin_catalog_dir", response_cache.CACHE_DIR)
+# how long the catalog on disk is used before asking the storage backend again (seconds)
+REFRESH = 60 * 60
+
+
+class Catalog:
+    """
+    Measurements of the bucket and their fields, loaded on first use and kept on disk
+    so that the dashboard does not have to query the storage backend when it starts
+    """
+    def __init__(self, backend, path=None, refresh=REFRESH):
+        self.backend = backend
+        self.path = path or os.path.join(CATALOG_DIR, f"catalog-{backend.name}.json")
+        self.refresh = refresh
+        self.measurements = None
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            if time.time() - os.path.getmtime(self.path) > self.refresh:
+                return None
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, measurements):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(measurements, f)
+        os.replace(tmp, self.path)
+
+    def get(self, force=False):
+        """
+        Args:
+            force: ask InfluxDB even if the catalog is still fresh
+        Returns:
+            measurements: dictionary of measurement: list of field names
+        """
+        with self.lock:
+            if not force and self.measurements is not None and time.time() - self.loaded_at <= self.refresh:
+                return self.measurements
+            measurements = None if force else self._read()
+            if measurements is None:
+                measurements = self.backend.getListOfMeasurements()
+                self._write(measurements)
+            self.measurements = measurements
+            self.loaded_at = time.time()
+            return measurements
+
+    def fields(self, measurements):
+        catalog = self.get()
+        return [field for measurement in measurements for field in catalog.get(measurement, [])]
@@ -0,0 +1,184 @@
+import argparse
+import base64
+import datetime
+import json
+import os
+import threading
+import time
+import numpy as np
+import catalog
+import storage
+
+# day numbers count the days since EPOCH like influxBackup.DAY
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def dayNumber(date):
+    return (date - EPOCH).days
+
+def dayDate(number):
+    return EPOCH + datetime.timedelta(days=int(number))
+
+def _ranges(dates):
+    # consecutive dates merged into (first, last) tuples
+    ranges = []
+    for date in dates:
+        if ranges and ranges[-1][1] + datetime.timedelta(days=1) == date:
+            ranges[-1] = (ranges[-1][0], date)
+        else:
+            ranges.append((date, date))
+    return ranges
+
+class Coverage:
+    """
+    Calendar days holding at least one point of every measurement, as one bitmap per measurement
+    starting at its first day. The bitmaps are built from the storage backend with a single
+    aggregate query, kept on disk next to the measurement catalog and updated by the backend
+    after every successful write, so that finding the missing days never scans the points.
+    """
+    def __init__(self, backend, path=None):
+        self.backend = backend
+        self.path = path or os.path.join(catalog.CATALOG_DIR, f"coverage-{backend.name}.json")
+        self.bitmaps = None
+        self.built = None
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.built = data["built"]
+        self.bitmaps = {}
+        for measurement, entry in data["measurements"].items():
+            bits = np.unpackbits(np.frombuffer(base64.b64decode(entry["bits"]), dtype=np.uint8))[:entry["days"]].astype(bool)
+            self.bitmaps[measurement] = (entry["first"], bits)
+        return True
+
+    def _write(self):
+        measurements = {measurement: {"first": int(first), "days": len(bits), "bits": base64.b64encode(np.packbits(bits).tobytes()).decode()}
+                        for measurement, (first, bits) in self.bitmaps.items()}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"built": self.built, "measurements": measurements}, f)
+        os.replace(tmp, self.path)
+
+    def _set(self, measurement, days):
+        if len(days) == 0:
+            return
+        days = np.asarray(days, dtype=np.int64)
+        low, high = int(days.min()), int(days.max())
+        first, bits = self.bitmaps.get(measurement, (low, np.zeros(0, dtype=bool)))
+        # the bitmap grows on both sides to hold the new days
+        start = min(first, low)
+        stop = max(first + len(bits), high + 1)
+        if start != first or stop != first + len(bits):
+            grown = np.zeros(stop - start, dtype=bool)
+            grown[first - start:first - start + len(bits)] = bits
+            bits = grown
+        bits[days - start] = True
+        self.bitmaps[measurement] = (start, bits)
+
+    def build(self, measurements=None):
+        """
+        Rebuild the bitmaps of measurements, all the measurements of the store by default
+        """
+        everything = measurements is None
+        measurements = measurements or list(self.backend.getListOfMeasurements())
+        start_time = time.perf_counter()
+        days = self.backend.getDays(measurements)
+        with self.lock:
+            if everything or (self.bitmaps is None and not self._read()):
+                self.bitmaps = {}
+            for measurement in measurements:
+                self.bitmaps.pop(measurement, None)
+            for measurement, numbers in days.items():
+                self._set(measurement, numbers)
+            self.built = time.time()
+            self._write()
+        print(f"Coverage of {len(measurements)} measurements built in {time.perf_counter() - start_time:.1f}s")
+        return self
+
+    def load(self, rebuild=False):
+        """
+        Read the bitmaps from disk, building them when there are none yet or rebuild is set
+        """
+        with self.lock:
+            loaded = not rebuild and self._read()
+        return self if loaded else self.build()
+
+    def add(self, days):
+        """
+        Mark the days of the points just written, does nothing until the coverage has been built
+
+        Args:
+            days: dictionary of measurement: iterable of day numbers since 1970-01-01
+        """
+        with self.lock:
+            if self.bitmaps is None and not self._read():
+                return
+            for measurement, numbers in days.items():
+                self._set(measurement, list(numbers))
+            self._write()
+
+    def covered(self, measurement, date):
+        if self.bitmaps is None:
+            self.load()
+        first, bits = self.bitmaps.get(measurement, (0, np.zeros(0, dtype=bool)))
+        index = dayNumber(date) - first
+        return 0 <= index < len(bits) and bool(bits[index])
+
+    def missing(self, measurement, start_date, stop_date):
+        """
+        Days between start_date and stop_date (both included) without any point of measurement
+        """
+        if self.bitmaps is None:
+            self.load()
+        first, bits = self.bitmaps.get(measurement, (0, np.zeros(0, dtype=bool)))
+        numbers = np.arange(dayNumber(start_date), dayNumber(stop_date) + 1)
+        index = numbers - first
+        inside = (index >= 0) & (index < len(bits))
+        present = np.zeros(len(numbers), dtype=bool)
+        present[inside] = bits[index[inside]]
+        return [dayDate(number) for number in numbers[~present]]
+
+    def report(self, start_date, stop_date, measurements=None):
+        """
+        Returns:
+            report: dictionary of measurement: dictionary with the number of days covered, the number
+                    of missing days and the missing days merged into (first, last) ranges
+        """
+        if self.bitmaps is None:
+            self.load()
+        days = (stop_date - start_date).days + 1
+        report = {}
+        for measurement in measurements or sorted(self.bitmaps):
+            missing = self.missing(measurement, start_date, stop_date)
+            report[measurement] = {"covered": days - len(missing), "missing": len(missing), "ranges": _ranges(missing)}
+        return report
+
+def printReport(report, start_date, stop_date, max_ranges=10):
+    days = (stop_date - start_date).days + 1
+    print(f"Days with data from {start_date} to {stop_date} ({days} days)")
+    print(f"{'measurement':<24}{'covered':>9}{'missing':>9}{'coverage':>10}  largest gaps")
+    for measurement, entry in report.items():
+        largest = sorted(entry["ranges"], key=lambda r: (r[1] - r[0]).days, reverse=True)[:max_ranges]
+        gaps = ", ".join(str(first) if first == last else f"{first}..{last}" for first, last in sorted(largest))
+        print(f"{measurement:<24}{entry['covered']:>9}{entry['missing']:>9}{entry['covered'] / days:>10.0%}  {gaps}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the days without data of every measurement")
+    parser.add_argument("--days", type=int, default=365, help="number of days up to yesterday covered by the report")
+    parser.add_argument("--measurement", action="append", default=None, help="only report this measurement, can be repeated")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the coverage from the storage backend first")
+    parser.add_argument("--storage", choices=sorted(storage.BACKENDS), default=storage.STORAGE, help="storage backend to report on")
+    args = parser.parse_args()
+    stop_date = datetime.date.today() - datetime.timedelta(days=1)
+    start_date = stop_date - datetime.timedelta(days=args.days - 1)
+    backend = storage.getBackend(args.storage)
+    index = Coverage(backend).load(rebuild=args.rebuild)
+    printReport(index.report(start_date, stop_date, args.measurement), start_date, stop_date)
+    backend.close()
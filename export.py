@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from influxdb_client.domain.dialect import Dialect
+import flux
+import influxBackup as influxBackup
+
+# where the snapshots are written, one directory per snapshot
+SNAPSHOT_DIR = os.environ.get("garmin_snapshot_dir", "snapshots")
+# rows parsed and written at a time, the memory used by an export does not grow past a few chunks
+CHUNK_ROWS = 100_000
+COMPRESSION = "zstd"
+# days exported again by an incremental snapshot before the end of the previous one, to catch late-arriving data
+OVERLAP_DAYS = 2
+# the #datatype annotation gives the type of every column before the first row is read
+CSV_DIALECT = Dialect(header=True, annotations=["datatype"], date_time_format="RFC3339")
+ARROW_TYPES = {
+    "long": pa.int64(),
+    "unsignedLong": pa.uint64(),
+    "double": pa.float64(),
+    "boolean": pa.bool_(),
+    "string": pa.string(),
+    "dateTime:RFC3339": pa.timestamp("ns", tz="UTC"),
+}
+PANDAS_TYPES = {"long": "Int64", "unsignedLong": "UInt64", "double": "float64", "boolean": "boolean", "string": "string"}
+RESULT_COLUMNS = ["", "result", "table"]
+MANIFEST = "manifest.json"
+
+
+def buildQuery(measurement, start, stop, bucket=influxBackup.bucket):
+    # one row per time and tag set with a column per field, tags are kept as columns
+    return f'from(bucket: "{bucket}")\
+        |> range(start: {flux.fluxTime(start)}, stop: {flux.fluxTime(stop)})\
+        |> filter(fn: (r) => r._measurement == "{measurement}")\
+        |> drop(columns: ["_start", "_stop", "_measurement"])\
+        |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")\
+        |> group()'
+
+def readChunks(response, chunk_rows=CHUNK_ROWS):
+    """
+    Read the CSV result of buildQuery with its #datatype annotation a chunk at a time
+
+    Args:
+        response: file-like object returned by query_raw
+    Returns:
+        schema: pyarrow schema of the result, None if the result is empty
+        chunks: generator of pyarrow tables of at most chunk_rows rows
+    """
+    datatypes = response.readline().decode().strip().split(",")
+    if not datatypes[0].startswith("#datatype"):
+        return None, iter([])
+    header = response.readline().decode().strip().split(",")
+    columns = [(name, datatype) for name, datatype in zip(header, datatypes) if name not in RESULT_COLUMNS]
+    schema = pa.schema([("time" if name == "_time" else name, ARROW_TYPES.get(datatype, pa.string())) for name, datatype in columns])
+    dtypes = {name: PANDAS_TYPES.get(datatype, "string") for name, datatype in columns if not datatype.startswith("dateTime")}
+    dates = [name for name, datatype in columns if datatype.startswith("dateTime")]
+
+    def chunks():
+        reader = pd.read_csv(response, names=header, usecols=[name for name, _ in columns], dtype=dtypes,
+                             chunksize=chunk_rows, header=None, true_values=["true"], false_values=["false"])
+        for df in reader:
+            for name in dates:
+                df[name] = flux.parseTimes(df[name])
+            df = df.rename(columns={"_time": "time"})
+            yield pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    return schema, chunks()
+
+class SnapshotWriter:
+    """
+    Writes the chunks of a measurement to one compressed file per month under
+    <directory>/measurement=<measurement>/month=<yyyy-mm>.<parquet|arrow>
+    """
+    def __init__(self, directory, measurement, schema, file_format="parquet", compression=COMPRESSION):
+        self.directory = os.path.join(directory, f"measurement={measurement}")
+        self.schema = schema
+        self.file_format = file_format
+        self.compression = compression
+        self.writers = {}
+
+    def _writer(self, month):
+        if month not in self.writers:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"month={month}.{self.file_format}")
+            if self.file_format == "parquet":
+                self.writers[month] = pq.ParquetWriter(path, self.schema, compression=self.compression)
+            else:
+                options = pa.ipc.IpcWriteOptions(compression=self.compression)
+                self.writers[month] = pa.ipc.new_file(path, self.schema, options=options)
+        return self.writers[month]
+
+    def write(self, table):
+        months = pc.strftime(table["time"], format="%Y-%m").to_pylist()
+        start = 0
+        # the rows come sorted by time so every month is a contiguous slice
+        for i in range(1, len(months) + 1):
+            if i == len(months) or months[i] != months[start]:
+                self._writer(months[start]).write_table(table.slice(start, i - start))
+                start = i
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+def readManifest(directory=SNAPSHOT_DIR):
+    """
+    Manifest of the latest snapshot, None when there is none yet
+    """
+    if not os.path.isdir(directory):
+        return None
+    snapshots = sorted(name for name in os.listdir(directory) if os.path.exists(os.path.join(directory, name, MANIFEST)))
+    if not snapshots:
+        return None
+    with open(os.path.join(directory, snapshots[-1], MANIFEST), encoding="utf-8") as f:
+        return json.load(f)
+
+def exportMeasurement(client, measurement, start, stop, directory, file_format="parquet", chunk_rows=CHUNK_ROWS, bucket=influxBackup.bucket, org=influxBackup.org):
+    """
+    Stream the points of a measurement between start and stop to the snapshot directory, a month per query
+
+    Returns:
+        rows: number of rows written
+    """
+    writer = None
+    rows = 0
+    query_api = client.query_api()
+    start, stop = flux.utcTimestamp(start), flux.utcTimestamp(stop)
+    try:
+        for month_start in pd.date_range(start.normalize().replace(day=1), stop, freq="MS"):
+            month_start = max(month_start, start)
+            month_stop = min(month_start.normalize().replace(day=1) + pd.offsets.MonthBegin(1), stop)
+            if month_start >= month_stop:
+                continue
+            response = query_api.query_raw(buildQuery(measurement, month_start, month_stop, bucket), org=org, dialect=CSV_DIALECT)
+            try:
+                schema, chunks = readChunks(response, chunk_rows)
+                for table in chunks:
+                    if writer is None or not writer.schema.equals(table.schema):
+                        # a month with other fields or types gets its own files
+                        if writer is not None:
+                            writer.close()
+                        writer = SnapshotWriter(directory, measurement, table.schema, file_format)
+                    writer.write(table.sort_by("time"))
+                    rows += len(table)
+            finally:
+                response.close()
+        return rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+def export(client, incremental=False, directory=SNAPSHOT_DIR, file_format="parquet", overlap=OVERLAP_DAYS, chunk_rows=CHUNK_ROWS, bucket=influxBackup.bucket, org=influxBackup.org):
+    """
+    Write a snapshot of every measurement of the bucket
+
+    Args:
+        client: InfluxDB client
+        incremental: only export the points newer than the previous snapshot, minus overlap days
+        directory: root of the snapshots
+        file_format: "parquet" or "arrow"
+    Returns:
+        path: directory of the new snapshot
+    """
+    stop = pd.Timestamp.now(tz="UTC").ceil("s")
+    previous = readManifest(directory) if incremental else None
+    path = os.path.join(directory, stop.strftime("%Y%m%dT%H%M%SZ"))
+    measurements = list(influxBackup.getListOfMeasurements(client, bucket, org))
+    first_timestamps = influxBackup.getFirstTimestamps(client, measurements, bucket, org)
+    manifest = {"created": stop.isoformat(), "incremental": previous is not None, "format": file_format, "measurements": {}}
+    start_time = time.perf_counter()
+    total = 0
+    for measurement in measurements:
+        if measurement not in first_timestamps:
+            continue
+        start = flux.utcTimestamp(first_timestamps[measurement]).floor("s")
+        if previous is not None and measurement in previous["measurements"]:
+            start = max(start, flux.utcTimestamp(previous["measurements"][measurement]["stop"]) - pd.Timedelta(days=overlap))
+        rows = exportMeasurement(client, measurement, start, stop, path, file_format, chunk_rows, bucket, org)
+        manifest["measurements"][measurement] = {"start": start.isoformat(), "stop": stop.isoformat(), "rows": rows}
+        total += rows
+        print(f"{measurement}: {rows} rows")
+    os.makedirs(path, exist_ok=True)
+    # written last, a snapshot without a manifest is incomplete and ignored by the next incremental one
+    with open(os.path.join(path, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    elapsed = time.perf_counter() - start_time
+    print(f"Exported {total} rows to {path} in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/sec)")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the bucket to compressed Parquet or Arrow snapshots")
+    parser.add_argument("--incremental", action="store_true", help="only export the points newer than the previous snapshot")
+    parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet", help="file format of the snapshot")
+    parser.add_argument("--dir", default=SNAPSHOT_DIR, help="directory holding the snapshots")
+    args = parser.parse_args()
+    influxdb_client = influxBackup.getInfuxClient()
+    export(influxdb_client, incremental=args.incremental, directory=args.dir, file_format=args.format)
+    influxdb_client.close()
@@ -0,0 +1,250 @@
+from garminconnect import GarminConnectTooManyRequestsError
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from tqdm import tqdm
+import threading
+import time
+import pandas as pd
+import metrics
+
+# default number of days fetched in parallel by the collectors in garmin.py
+WORKERS = 4
+# default request budget shared by every collector (requests per second)
+RATE = 3.0
+BURST = 6
+# how many times a single day is retried after a 429 before giving up
+MAX_RETRIES = 5
+# longest wait after a rate limit error (seconds), whatever the headers ask for
+MAX_WAIT = 15 * 60
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the workers talking to Garmin Connect.
+
+    Every request takes a token with acquire(). When Garmin answers with a 429,
+    backoff() pauses the whole bucket so the other workers wait as well instead
+    of hammering the server.
+    """
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def backoff(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = max(self.updated, self.paused_until)
+
+default_limiter = RateLimiter()
+
+
+class CountingLimiter:
+    """
+    View of a RateLimiter that counts the requests made through it, used to
+    report the number of requests of each stage while they share one budget
+    """
+    def __init__(self, limiter=None):
+        self.limiter = limiter or default_limiter
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.limiter.acquire()
+        with self.lock:
+            self.requests += 1
+
+    def backoff(self, seconds):
+        self.limiter.backoff(seconds)
+
+
+def _response_of(err):
+    # garminconnect wraps the requests error in different ways depending on where it was raised
+    response = getattr(err, "response", None)
+    if response is None and hasattr(err, "error"):
+        response = getattr(err.error, "response", None)
+    return response
+
+def is_rate_limited(err):
+    if isinstance(err, GarminConnectTooManyRequestsError):
+        return True
+    response = _response_of(err)
+    if response is not None and response.status_code == 429:
+        return True
+    # raised by requests once garth's own retries on 429 are exhausted
+    return "429" in str(err) and "too many" in str(err).lower()
+
+def retry_after(err, default):
+    """
+    Number of seconds to wait before retrying after a rate limit error, taken
+    from the X-RateLimit-Reset / Retry-After headers when Garmin sends them.
+    A value later than now is an epoch time rather than a delay, the wait is
+    capped at MAX_WAIT.
+    """
+    response = _response_of(err)
+    if response is not None:
+        for header in ("X-RateLimit-Reset", "Retry-After"):
+            value = response.headers.get(header)
+            try:
+                wait = float(value)
+            except (TypeError, ValueError):
+                continue
+            now = time.time()
+            if wait > now:
+                wait -= now
+            return min(max(wait, 0), MAX_WAIT)
+    return default
+
+def _fetch_with_retry(fetch, date, limiter, max_retries, cache=None, endpoint=None):
+    if cache is not None:
+        hit, response = cache.get(endpoint, date)
+        if hit:
+            return response
+    # requests made without an endpoint name are counted together
+    label = endpoint or "other"
+    attempt = 0
+    while True:
+        limiter.acquire()
+        metrics.inc("requests_total", endpoint=label)
+        start_time = time.perf_counter()
+        try:
+            response = fetch(date)
+            metrics.observe("request_seconds", time.perf_counter() - start_time, endpoint=label)
+            if cache is not None:
+                cache.put(endpoint, date, response)
+            return response
+        except Exception as err:
+            metrics.observe("request_seconds", time.perf_counter() - start_time, endpoint=label)
+            rate_limited = is_rate_limited(err)
+            if rate_limited:
+                metrics.inc("rate_limited_total", endpoint=label)
+            if not rate_limited or attempt >= max_retries:
+                metrics.inc("request_errors_total", endpoint=label)
+                raise
+            wait = retry_after(err, default=2 ** attempt * 5)
+            print(f"Rate limit exceeded on {date.isoformat()}. Retry after {wait} seconds.")
+            metrics.inc("retries_total", endpoint=label)
+            limiter.backoff(wait)
+            attempt += 1
+
+def call(fetch, label, limiter=None, max_retries=MAX_RETRIES, endpoint=None):
+    """
+    Make a single rate limited request to Garmin Connect, retried after 429 responses
+
+    Args:
+        fetch: function without arguments making the request
+        label: datetime.date the request is about, used in the log messages
+        limiter: RateLimiter shared between the requests, defaults to default_limiter
+        max_retries: number of retries after a rate limit error
+        endpoint: name of the endpoint in the metrics
+    Returns:
+        response: the value returned by fetch
+    """
+    return _fetch_with_retry(lambda _: fetch(), label, limiter or default_limiter, max_retries, endpoint=endpoint)
+
+def _result(key, future, journal, source):
+    try:
+        return future.result()
+    except Exception:
+        if journal is not None:
+            journal.failed(source, key)
+        raise
+
+def _iter_keys(fetch, keys, unit, workers, limiter, max_retries, cache, endpoint, journal=None, source=None):
+    limiter = limiter or default_limiter
+    if journal is not None:
+        skipped = len(keys)
+        keys = journal.pending(source, keys)
+        if skipped > len(keys):
+            print(f"{skipped - len(keys)} {unit} of {source} already complete in the journal")
+    window = 2 * max(1, workers)
+    pending = deque()
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor, tqdm(total=len(keys)) as progress:
+        for key in keys:
+            pending.append((key, executor.submit(_fetch_with_retry, fetch, key, limiter, max_retries, cache, endpoint)))
+            if len(pending) >= window:
+                key, future = pending.popleft()
+                progress.update()
+                yield key, _result(key, future, journal, source)
+        while pending:
+            key, future = pending.popleft()
+            progress.update()
+            yield key, _result(key, future, journal, source)
+    elapsed = time.perf_counter() - start_time
+    if keys:
+        print(f"Fetched {len(keys)} {unit} in {elapsed:.1f}s ({len(keys) / max(elapsed, 1e-9):.2f} {unit}/sec)")
+    if cache is not None:
+        cache.evict()
+        stats = cache.stats()
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
+
+def iter_days(fetch, start_date, stop_date, workers=WORKERS, limiter=None, max_retries=MAX_RETRIES,
+              cache=None, endpoint=None, journal=None, source=None):
+    """
+    Call fetch(date) for every day between start_date and stop_date on a pool of workers
+    and yield the responses in date order as soon as they are available.
+
+    At most 2 * workers days are requested ahead of the consumer, so a slow consumer
+    (e.g. a write to InfluxDB) holds the fetching back instead of piling up responses.
+
+    Args:
+        fetch: function taking a datetime.date and returning the Garmin response for that day
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: RateLimiter shared between the requests, defaults to default_limiter
+        max_retries: number of retries for a day after a rate limit error
+        cache: optional response_cache.ResponseCache checked before calling fetch
+        endpoint: name under which the responses are stored in the cache
+        journal: optional journal.Journal, the days it holds as complete for source are not fetched
+                 and the days whose requests fail are recorded as failed
+        source: name of the collector in the journal
+    Yields:
+        (date, response) tuples in date order
+    """
+    dates = [date.date() for date in pd.date_range(start_date, stop_date)]
+    yield from _iter_keys(fetch, dates, "days", workers, limiter, max_retries, cache, endpoint, journal, source)
+
+def iter_months(fetch, start_date, stop_date, workers=WORKERS, limiter=None, max_retries=MAX_RETRIES,
+                cache=None, endpoint=None, journal=None, source=None):
+    """
+    Same as iter_days for endpoints that accept a date range, fetch is called once per
+    calendar month touched by start_date..stop_date with the last day of the month.
+
+    Months are aligned on the calendar rather than on start_date so that the cache keys
+    stay the same from one run to the next, and a month is settled once its last day is.
+    The journal records a month under its last day.
+
+    Yields:
+        (month_end, response) tuples in date order
+    """
+    month_ends = []
+    if start_date <= stop_date:
+        month_ends = [date.date() for date in pd.date_range(start_date, pd.Timestamp(stop_date) + pd.offsets.MonthEnd(0), freq="M")]
+    yield from _iter_keys(fetch, month_ends, "months", workers, limiter, max_retries, cache, endpoint, journal, source)
+
+def fetch_days(*args, **kwargs):
+    """
+    Same as iter_days but returns the list of (date, response) tuples
+    """
+    return list(iter_days(*args, **kwargs))
@@ -0,0 +1,40 @@
+from datetime import datetime, timezone
+import pandas as pd
+
+# helpers shared by the modules building Flux queries and reading their CSV results,
+# kept apart so that any of them can import it without importing each other
+
+
+def fluxTime(date):
+    """
+    RFC3339 time for a Flux range from a datetime.date or datetime.datetime object,
+    naive datetimes are taken as UTC
+    """
+    if not isinstance(date, datetime):
+        date = datetime(date.year, date.month, date.day)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc)
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def utcTimestamp(date):
+    """
+    UTC pandas Timestamp of a datetime.date, datetime.datetime, pandas Timestamp or time string,
+    naive times are taken as UTC like in fluxTime. None stays None
+    """
+    if date is None:
+        return None
+    timestamp = pd.Timestamp(date)
+    return timestamp.tz_localize("UTC") if timestamp.tzinfo is None else timestamp.tz_convert("UTC")
+
+def parseTimes(times):
+    """
+    Parse a pandas Series of the RFC3339 times of a CSV query result into UTC datetimes
+    """
+    # times are always UTC, parsing them without the trailing Z is several times faster
+    return pd.to_datetime(times.str.rstrip("Z"), format="ISO8601").dt.tz_localize("UTC")
+
+def anyOf(column, values):
+    """
+    Flux predicate matching the records whose column is one of values
+    """
+    return " or ".join(f'r.{column} == "{value}"' for value in values)
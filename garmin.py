@@ -5,56 +5,89 @@ from garminconnect import (
     GarminConnectTooManyRequestsError,
     GarminConnectAuthenticationError,
 )
+from garth.exc import GarthException
+import requests
 import datetime
 import json
 from tqdm import tqdm
 import numpy as np
-# use plotly
-#pip install plotly
-import plotly.graph_objects as go
-# use influxdb
 import os, time
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+import calendar
 import pandas as pd
 from dotenv import load_dotenv
+import fetcher
 
 load_dotenv()
 
 username = os.environ.get('garmin_username')
 password = os.environ.get('garmin_password')
 
+# directory where authenticate saves the session tokens between runs
+TOKENSTORE = os.path.expanduser(os.environ.get('garmin_tokenstore', '~/.garminconnect'))
+# seconds taken by the last call to authenticate
+login_latency = None
+
+# number of activities requested per page by iter_activities
+ACTIVITIES_PAGE_SIZE = 100
+
 # Function to authenticate with Garmin Connect
-def authenticate(username, password):
-    try:
-        # Create Garmin client
-        client = Garmin(username, password)
-
-        # Authenticate with Garmin Connect
-        client.login()
-
-        return client
-
-    except (
-        GarminConnectConnectionError,
-        GarminConnectAuthenticationError,
-        GarminConnectTooManyRequestsError,
-    ) as err:
-        if hasattr(err, "response") and err.response.status_code == 429:
-            # Extract headers from the response
-            headers = err.response.headers
-            limit = headers.get("X-RateLimit-Limit")
-            remaining = headers.get("X-RateLimit-Remaining")
-            reset_time = headers.get("X-RateLimit-Reset")
-
-            print(f"Rate limit exceeded. Retry after {reset_time} seconds.")
-            quit()
-        else:
-            print(f"Error occurred: {err}")
-            quit()
-    except Exception as err:
-        print(f"Unknown error occurred: {err}")
-        quit()
+def authenticate(username, password, tokenstore=TOKENSTORE, max_retries=fetcher.MAX_RETRIES):
+    """
+    Log in to Garmin Connect, reusing the session tokens saved by a previous run when they are still valid
+
+    Args:
+        username: Garmin Connect email
+        password: Garmin Connect password
+        tokenstore: directory where the session tokens are saved
+        max_retries: number of login attempts after a rate limit error
+    Returns:
+        client: authenticated Garmin client, None if the login failed
+    """
+    global login_latency
+    # Create Garmin client
+    client = Garmin(username, password)
+    start_time = time.perf_counter()
+
+    if os.path.isdir(tokenstore):
+        try:
+            # garth refreshes the OAuth2 token from the saved OAuth1 token when it has expired
+            client.login(tokenstore)
+            login_latency = time.perf_counter() - start_time
+            print(f"Logged in with saved session in {login_latency:.2f}s")
+            return client
+        except Exception as err:
+            print(f"Saved session could not be used ({err}), logging in with credentials")
+            client = Garmin(username, password)
+
+    attempt = 0
+    while True:
+        try:
+            # Authenticate with Garmin Connect
+            client.login()
+            break
+        except (
+            GarminConnectConnectionError,
+            GarminConnectAuthenticationError,
+            GarminConnectTooManyRequestsError,
+            GarthException,
+            requests.exceptions.RequestException,
+        ) as err:
+            if fetcher.is_rate_limited(err) and attempt < max_retries:
+                reset_time = fetcher.retry_after(err, default=2 ** attempt * 30)
+                print(f"Rate limit exceeded. Retry after {reset_time} seconds.")
+                time.sleep(reset_time)
+                attempt += 1
+            else:
+                print(f"Error occurred: {err}")
+                return None
+        except Exception as err:
+            print(f"Unknown error occurred: {err}")
+            return None
+
+    client.garth.dump(tokenstore)
+    login_latency = time.perf_counter() - start_time
+    print(f"Logged in with credentials in {login_latency:.2f}s")
+    return client
 
 def garmin_hr_to_hr_related_schema(response):
     
@@ -82,6 +115,47 @@ def garmin_hr_to_hr_schema(response):
             }
         } for t, hr in response["heartRateValues"]]
     
+def _utc_offsets_ms(t):
+    # garmin_hr_to_hr_schema stores datetime.datetime.fromtimestamp(t), i.e. local wall clock time
+    # which InfluxDB then reads as UTC, so the columnar path shifts the epoch by the local UTC offset
+    seconds = t // 1000
+    first = calendar.timegm(time.localtime(int(seconds[0]))) - int(seconds[0])
+    last = calendar.timegm(time.localtime(int(seconds[-1]))) - int(seconds[-1])
+    if first == last:
+        return first * 1000
+    # the day crosses a daylight saving change
+    return np.fromiter((calendar.timegm(time.localtime(s)) - s for s in seconds.tolist()), dtype=np.int64, count=len(seconds)) * 1000
+
+def garmin_hr_to_hr_arrays(response):
+    """
+    Columnar version of garmin_hr_to_hr_schema
+
+    Args:
+        response: get_heart_rates response
+    Returns:
+        times: int64 array of timestamps in nanoseconds, matching the times written by garmin_hr_to_hr_schema
+        values: int64 array of heart rate values, samples without a value are dropped
+    """
+    samples = response["heartRateValues"]
+    if not samples:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # None becomes nan, epoch milliseconds are exact in a float64
+    samples = np.array(samples, dtype=np.float64)
+    samples = samples[~np.isnan(samples[:, 1])]
+    if len(samples) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    t = samples[:, 0].astype(np.int64)
+    times = (t + _utc_offsets_ms(t)) * 1_000_000
+    return times, samples[:, 1].astype(np.int64)
+
+def garmin_hr_to_hr_line_protocol(response):
+    """
+    Get the heart rate samples of a get_heart_rates response as line protocol ready for influxBackup.backupData,
+    without building a dictionary per sample
+    """
+    times, values = garmin_hr_to_hr_arrays(response)
+    return [f"RealTimeHeartRate,unit=bpm heartRateValue={hr}i {t}" for t, hr in zip(times.tolist(), values.tolist())]
+
 def garmin_weight_to_weight_schema(response):
     return {
         "measurement": "Weight",
@@ -94,16 +168,27 @@ def garmin_weight_to_weight_schema(response):
         }
     }
     
+def garmin_weight_summary_to_weight_schema(summary):
+    # one entry of the dailyWeightSummaries returned by get_weigh_ins for a date range
+    return {
+        "measurement": "Weight",
+        "tags": {
+            "unit": "g"
+        },
+        "time": summary["summaryDate"],
+        "fields": {
+            "weight": summary["latestWeight"]["weight"],
+        }
+    }
+    
 def garmin_hrv_to_hrv_schema(response):
     
     # one line version of the above
     weeklyAvg = response["hrvSummary"]["weeklyAvg"] if response["hrvSummary"]["weeklyAvg"] != None else None
     lastNightAvg = response["hrvSummary"]["lastNightAvg"] if response["hrvSummary"]["lastNightAvg"] != None else None
-    lastNight5MinHigh = response["hrvSummary"]["lastNight5MinHigh"] if response["hrvSummary"] != None else None
     lowUpper = response["hrvSummary"]["baseline"]["lowUpper"] if response["hrvSummary"]["baseline"] != None else None
     balancedLow = response["hrvSummary"]["baseline"]["balancedLow"] if response["hrvSummary"]["baseline"] != None else None
     balancedUpper = response["hrvSummary"]["baseline"]["balancedUpper"] if response["hrvSummary"]["baseline"] != None else None
-    markerValue = response["hrvSummary"]["baseline"]["markerValue"] if response["hrvSummary"]["baseline"] != None else None
     status = response["hrvSummary"]["status"] if response["hrvSummary"]["status"] != None else None
     
     
@@ -146,8 +231,87 @@ def garmin_blood_pressure_to_blood_pressure_schema(response):
                 "pulse": bp["measurements"][0]["pulse"],
             }
         } for bp in response["measurementSummaries"]]
+
+def garmin_activity_to_activity_schema(activity):
+    # times are local like the other measurements
+    return {
+        "measurement": "Activity",
+        "tags": {
+            "activityType": activity["activityType"]["typeKey"],
+        },
+        "time": activity["startTimeLocal"],
+        "fields": {
+            "activityId": activity["activityId"],
+            "activityName": activity.get("activityName"),
+            "duration": activity.get("duration"),
+            "distance": activity.get("distance"),
+            "calories": activity.get("calories"),
+            "averageHR": activity.get("averageHR"),
+            "maxHR": activity.get("maxHR"),
+            "elevationGain": activity.get("elevationGain"),
+            "averageSpeed": activity.get("averageSpeed"),
+            "steps": activity.get("steps"),
+        }
+    }
+
+def _record(journal, source, date, count):
+    # called when the consumer asks for the next day, the spool has then written the data of this
+    # one to disk (main.py does not record days when it writes straight to the storage backend)
+    if journal is None:
+        return
+    if count:
+        journal.done(source, date, count)
+    else:
+        journal.empty(source, date)
+
+def flatten(chunks):
+    """
+    Concatenate the per-day lists yielded by the iter_* collectors into a single list
+    """
+    return [data_point for chunk in chunks for data_point in chunk]
     
-def get_weight(client, start_date, stop_date):
+def iter_weight(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None, journal=None):
+    """
+    Get weight data from Garmin Connect one month at a time, get_weigh_ins accepts a date range
+    so a single request covers a whole month
+    
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of months fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+        journal: optional journal.Journal, days already complete are skipped and finished days are recorded
+    Yields:
+        weight_data: list of the month's weight data using the weight_schema
+    """
+    print("Getting weight data")
+    responses = fetcher.iter_months(lambda month_end: client.get_weigh_ins(month_end.replace(day=1).isoformat(), month_end.isoformat()),
+                                    start_date, stop_date, workers=workers, limiter=limiter,
+                                    cache=cache, endpoint="weigh_ins_month", journal=journal, source="weight")
+    for month_end, response in responses:
+        if response is None:
+            print("No weight data for", month_end.strftime("%Y-%m"))
+            continue
+        weight_data = []
+        for summary in response["dailyWeightSummaries"]:
+            # the first and last months are only partly inside the requested range
+            date = datetime.date.fromisoformat(summary["summaryDate"])
+            if start_date <= date <= stop_date and summary["latestWeight"]["weight"] is not None:
+                weight_data.append(garmin_weight_summary_to_weight_schema(summary))
+        yield weight_data
+        if journal is not None:
+            # every day of the month in range is recorded, the month end too when the range starts
+            # later in the month, otherwise the first month would be fetched again by every run
+            month_start = month_end.replace(day=1)
+            counts = {}
+            for data_point in weight_data:
+                counts[data_point["time"]] = counts.get(data_point["time"], 0) + 1
+            for date in pd.date_range(max(month_start, start_date), min(month_end, stop_date)):
+                _record(journal, "weight", date.date(), counts.get(date.date().isoformat(), 0))
+
+def get_weight(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None):
     """
     Get weight data from Garmin Connect
     
@@ -155,23 +319,43 @@ def get_weight(client, start_date, stop_date):
         client: Garmin client
         start_date: datetime.date object
         stop_date: datetime.date object
+        workers: number of months fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
     Returns:
         weight_data: list of weight data using the weight_schema
     """
-    print("Getting weight data")
-    weight_data = []
-    for date in tqdm(list(pd.date_range(start_date, stop_date))):
-        response = client.get_weigh_ins(date.isoformat(), date.isoformat())
+    return flatten(iter_weight(client, start_date, stop_date, workers, limiter, cache))
+
+def iter_hrv_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None, journal=None):
+    """
+    Get heart rate variability data from Garmin Connect one day at a time
+    
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+        journal: optional journal.Journal, days already complete are skipped and finished days are recorded
+    Yields:
+        hrv_data: list of the day's heart rate variability data using the hrv_schema
+    """
+    print("Getting hrv data")
+    responses = fetcher.iter_days(lambda date: client.get_hrv_data(date.isoformat()),
+                                  start_date, stop_date, workers=workers, limiter=limiter,
+                                  cache=cache, endpoint="hrv", journal=journal, source="hrv")
+    for date, response in responses:
         if response is None:
-            print("No weight data for", date.isoformat())
+            print("No heart rate variability data for", date.isoformat())
+            _record(journal, "hrv", date, 0)
             continue
         else:
-            if response["previousDateWeight"]["weight"] is not None:
-                weight_data.append(garmin_weight_to_weight_schema(response))
-    
-    return weight_data
+            yield [garmin_hrv_to_hrv_schema(response)]
+            _record(journal, "hrv", date, 1)
 
-def get_hrv_data(client, start_date, stop_date):
+def get_hrv_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None):
     """
     Get heart rate variability data from Garmin Connect
     
@@ -179,21 +363,43 @@ def get_hrv_data(client, start_date, stop_date):
         client: Garmin client
         start_date: datetime.date object
         stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
     Returns:
         hrv_data: list of heart rate variability data using the hrv_schema
     """
-    print("Getting hrv data")
-    hrv_data = []
-    for date in tqdm(list(pd.date_range(start_date, stop_date))):
-        response = client.get_hrv_data(date.isoformat())
+    return flatten(iter_hrv_data(client, start_date, stop_date, workers, limiter, cache))
+
+def iter_hr_related_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None, journal=None):
+    """
+    Get heart rate related data from Garmin Connect one day at a time
+    
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+        journal: optional journal.Journal, days already complete are skipped and finished days are recorded
+    Yields:
+        hr_data: list of the day's heart rate related data using the hr_adj_schema
+    """
+    print("Getting heart rate related data")
+    responses = fetcher.iter_days(lambda date: client.get_heart_rates(date.isoformat()),
+                                  start_date, stop_date, workers=workers, limiter=limiter,
+                                  cache=cache, endpoint="heart_rates", journal=journal, source="hr_related")
+    for date, response in responses:
         if response is None:
-            print("No heart rate variability data for", date.isoformat())
+            print("No heart rate data for", date.isoformat())
+            _record(journal, "hr_related", date, 0)
             continue
         else:
-            hrv_data.append(garmin_hrv_to_hrv_schema(response))
-    return hrv_data
+            yield [garmin_hr_to_hr_related_schema(response)]
+            _record(journal, "hr_related", date, 1)
 
-def get_hr_related_data(client, start_date, stop_date):
+def get_hr_related_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None):
     """
     Get heart rate related data from Garmin Connect
     
@@ -201,21 +407,47 @@ def get_hr_related_data(client, start_date, stop_date):
         client: Garmin client
         start_date: datetime.date object
         stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
     Returns:
         hr_data: list of heart rate related data using the hr_adj_schema
     """
-    print("Getting heart rate related data")
-    hr_data = []
-    for date in tqdm(list(pd.date_range(start_date, stop_date))):
-        response = client.get_heart_rates(date.isoformat())
+    return flatten(iter_hr_related_data(client, start_date, stop_date, workers, limiter, cache))
+
+def iter_hr_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None, line_protocol=False, journal=None):
+    """
+    Get heart rate data from Garmin Connect one day at a time
+    
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+        line_protocol: yield the heart rate data as line protocol strings instead of hr_schema dictionaries
+        journal: optional journal.Journal, days already complete are skipped and finished days are recorded
+    Yields:
+        hr_data: list of the day's heart rate data using the hr_schema
+    """
+    print("Getting heart rate data")
+    responses = fetcher.iter_days(lambda date: client.get_heart_rates(date.isoformat()),
+                                  start_date, stop_date, workers=workers, limiter=limiter,
+                                  cache=cache, endpoint="heart_rates", journal=journal, source="hr_data")
+    for date, response in responses:
         if response is None:
             print("No heart rate data for", date.isoformat())
+            _record(journal, "hr_data", date, 0)
             continue
+        elif response["heartRateValues"] is not None:
+            hr_data = garmin_hr_to_hr_line_protocol(response) if line_protocol else garmin_hr_to_hr_schema(response)
+            yield hr_data
+            _record(journal, "hr_data", date, len(hr_data))
         else:
-            hr_data.append(garmin_hr_to_hr_related_schema(response))
-    return hr_data
+            _record(journal, "hr_data", date, 0)
 
-def get_hr_data(client, start_date, stop_date):
+def get_hr_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None):
     """
     Get heart rate data from Garmin Connect
     
@@ -223,47 +455,144 @@ def get_hr_data(client, start_date, stop_date):
         client: Garmin client
         start_date: datetime.date object
         stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
     Returns:
         hr_data: list of heart rate data using the hr_schema
     """
-    print("Getting heart rate data")
-    hr_data = []
-    for date in tqdm(list(pd.date_range(start_date, stop_date))):
-        response = client.get_heart_rates(date.isoformat())
-        # print(response)
+    return flatten(iter_hr_data(client, start_date, stop_date, workers, limiter, cache))
+
+def iter_all_hr_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None, line_protocol=False, journal=None):
+    """
+    Get heart rate related data and heart rate data from Garmin Connect one day at a time,
+    each day's get_heart_rates response is downloaded once and converted to both schemas
+
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+        line_protocol: yield the heart rate data as line protocol strings instead of hr_schema dictionaries
+        journal: optional journal.Journal, days already complete are skipped and finished days are recorded
+    Yields:
+        hr_related_data: list of the day's heart rate related data using the hr_adj_schema
+        hr_data: list of the day's heart rate data using the hr_schema
+    """
+    print("Getting heart rate related data and heart rate data")
+    responses = fetcher.iter_days(lambda date: client.get_heart_rates(date.isoformat()),
+                                  start_date, stop_date, workers=workers, limiter=limiter,
+                                  cache=cache, endpoint="heart_rates", journal=journal, source="hr")
+    for date, response in responses:
         if response is None:
             print("No heart rate data for", date.isoformat())
+            _record(journal, "hr", date, 0)
             continue
-        elif response["heartRateValues"] is not None:
-            hrs = garmin_hr_to_hr_schema(response)
-            for hr in hrs:
-                hr_data.append(hr)
-    return hr_data
+        hr_data = []
+        if response["heartRateValues"] is not None:
+            hr_data = garmin_hr_to_hr_line_protocol(response) if line_protocol else garmin_hr_to_hr_schema(response)
+        yield [garmin_hr_to_hr_related_schema(response)], hr_data
+        _record(journal, "hr", date, 1 + len(hr_data))
 
-def get_VO2Max(client, start_date, stop_date):
+def get_all_hr_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None):
     """
-    Get VO2Max data from Garmin Connect
-    
+    Get heart rate related data and heart rate data from Garmin Connect in a single pass,
+    each day's get_heart_rates response is downloaded once and converted to both schemas
+
     Args:
         client: Garmin client
         start_date: datetime.date object
         stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
     Returns:
-        vo2max_data: list of VO2Max data using the vo2max_schema
+        hr_related_data: list of heart rate related data using the hr_adj_schema
+        hr_data: list of heart rate data using the hr_schema
+    """
+    hr_related_data = []
+    hr_data = []
+    for day_hr_related_data, day_hr_data in iter_all_hr_data(client, start_date, stop_date, workers, limiter, cache):
+        hr_related_data.extend(day_hr_related_data)
+        hr_data.extend(day_hr_data)
+    return hr_related_data, hr_data
+
+def iter_VO2Max(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None, journal=None):
+    """
+    Get VO2Max data from Garmin Connect one day at a time
+    
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+        journal: optional journal.Journal, days already complete are skipped and finished days are recorded
+    Yields:
+        vo2max_data: list of the day's VO2Max data using the vo2max_schema
     """
     print("Getting VO2Max data")
-    vo2max_data = []
-    for date in tqdm(list(pd.date_range(start_date, stop_date))):
-        response = client.get_max_metrics(date.isoformat())
-        # print(response)
+    responses = fetcher.iter_days(lambda date: client.get_max_metrics(date.isoformat()),
+                                  start_date, stop_date, workers=workers, limiter=limiter,
+                                  cache=cache, endpoint="max_metrics", journal=journal, source="vo2max")
+    for date, response in responses:
         if response is None or len(response) == 0:
             print("No VO2Max data for", date.isoformat())
+            _record(journal, "vo2max", date, 0)
             continue
         else:
-            vo2max_data.append(garmin_vo2max_to_vo2max_schema(response[0]))
-    return vo2max_data
+            yield [garmin_vo2max_to_vo2max_schema(response[0])]
+            _record(journal, "vo2max", date, 1)
+
+def get_VO2Max(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None):
+    """
+    Get VO2Max data from Garmin Connect
     
-def get_activities(client, start_date, stop_date):
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+    Returns:
+        vo2max_data: list of VO2Max data using the vo2max_schema
+    """
+    return flatten(iter_VO2Max(client, start_date, stop_date, workers, limiter, cache))
+    
+def iter_activities(client, start_date, stop_date, page_size=ACTIVITIES_PAGE_SIZE, limiter=None):
+    """
+    Get activities data from Garmin Connect one page at a time
+    
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        page_size: number of activities requested per page
+        limiter: fetcher.RateLimiter shared between the requests
+    Yields:
+        activities_data: list of the page's activities data using the activities_schema
+    """
+    print("Getting activities data")
+    params = {
+        "startDate": start_date.isoformat(),
+        "endDate": stop_date.isoformat(),
+        "start": 0,
+        "limit": page_size,
+    }
+    while True:
+        page = fetcher.call(lambda: client.connectapi(client.garmin_connect_activities, params=params), stop_date, limiter=limiter, endpoint="activities")
+        if not page:
+            break
+        yield [garmin_activity_to_activity_schema(activity) for activity in page]
+        if len(page) < page_size:
+            break
+        params["start"] += page_size
+
+def get_activities(client, start_date, stop_date, page_size=ACTIVITIES_PAGE_SIZE, limiter=None):
     """
     Get activities data from Garmin Connect
     
@@ -271,22 +600,14 @@ def get_activities(client, start_date, stop_date):
         client: Garmin client
         start_date: datetime.date object
         stop_date: datetime.date object
+        page_size: number of activities requested per page
+        limiter: fetcher.RateLimiter shared between the requests
     Returns:
         activities_data: list of activities data using the activities_schema
     """
-    print("Getting activities data")
-    activities_data = []
-    # for date in tqdm(list(pd.date_range(start_date, stop_date))):
-    response = client.get_activities_by_date(start_date.isoformat(), stop_date.isoformat())
-    print(response)
-    #     if response is None:
-    #         print("No activities data for", date.isoformat())
-    #         continue
-    #     else:
-    #         activities_data.append(garmin_activities_to_activities_schema(response))
-    # return activities_data
-    
-def get_blood_pressures(client, start_date, stop_date):
+    return flatten(iter_activities(client, start_date, stop_date, page_size, limiter))
+    
+def get_blood_pressures(client, start_date, stop_date, limiter=None):
     """
     Get blood pressure data from Garmin Connect
     
@@ -294,11 +615,12 @@ def get_blood_pressures(client, start_date, stop_date):
         client: Garmin client
         start_date: datetime.date object
         stop_date: datetime.date object
+        limiter: fetcher.RateLimiter shared between the requests
     Returns:
         blood_pressure_data: list of blood pressure data using the blood_pressure_schema
     """
     print("Getting blood pressure data")
-    response = client.get_blood_pressure(start_date.isoformat(), stop_date.isoformat())
+    response = fetcher.call(lambda: client.get_blood_pressure(start_date.isoformat(), stop_date.isoformat()), stop_date, limiter=limiter, endpoint="blood_pressure")
     blood_pressure_data = None
     if response is None or len(response) == 0:
         print("No blood pressure data")
@@ -306,30 +628,49 @@ def get_blood_pressures(client, start_date, stop_date):
         blood_pressure_data = garmin_blood_pressure_to_blood_pressure_schema(response)
     return blood_pressure_data
 #{data:values ....}
-def get_garmin_sleep_data(client, start_date, stop_date):
+def iter_garmin_sleep_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None, journal=None):
     """
-    Get sleep data from Garmin Connect
+    Get sleep data from Garmin Connect one day at a time
     
     Args:
         client: Garmin client
         start_date: datetime.date object
         stop_date: datetime.date object
-    Returns:
-        sleep_data: list of sleep data using the sleep_schema
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+        journal: optional journal.Journal, days already complete are skipped and finished days are recorded
+    Yields:
+        sleep_data: list of the day's sleep data using the sleep_schema
     """
     print("Getting sleep data")
-    sleep_data = []
-    for date in tqdm(list(pd.date_range(start_date, stop_date))):
-        # convert date from: 2023-11-24T00%3A00%3A00 to yyyy-mm-dd
-        date = date.date()
-        response = client.get_sleep_data(date.isoformat())
-        # print(response)
+    responses = fetcher.iter_days(lambda date: client.get_sleep_data(date.isoformat()),
+                                  start_date, stop_date, workers=workers, limiter=limiter,
+                                  cache=cache, endpoint="sleep", journal=journal, source="sleep")
+    for date, response in responses:
         if response is None:
             print("No sleep data for", date.isoformat())
+            _record(journal, "sleep", date, 0)
             continue
         else:
-            sleep_data.append(garmin_sleep_to_sleep_schema(response))
-    return sleep_data
+            yield [garmin_sleep_to_sleep_schema(response)]
+            _record(journal, "sleep", date, 1)
+
+def get_garmin_sleep_data(client, start_date, stop_date, workers=fetcher.WORKERS, limiter=None, cache=None):
+    """
+    Get sleep data from Garmin Connect
+    
+    Args:
+        client: Garmin client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        workers: number of days fetched in parallel
+        limiter: fetcher.RateLimiter shared between the requests
+        cache: optional response_cache.ResponseCache holding the raw responses
+    Returns:
+        sleep_data: list of sleep data using the sleep_schema
+    """
+    return flatten(iter_garmin_sleep_data(client, start_date, stop_date, workers, limiter, cache))
 
 def garmin_sleep_to_sleep_schema(response):
     try:
@@ -428,20 +769,22 @@ def sendSleepToObsidinan(data):
             if "sleep_score" not in f.readlines():
                 f.write(line)                
                 
-def get_personal_info(client):
+def get_personal_info(client, limiter=None):
     """
     Get personal info from Garmin Connect
     
     Args:
         client: Garmin client
+        limiter: fetcher.RateLimiter shared between the requests
     Returns:
         personal_info: list of personal info using the personal_info_schema
     """
     garmin_connect_user_settings_url = (
             "/userprofile-service/userprofile/user-settings"
         )
-    response = client.connectapi(garmin_connect_user_settings_url)
+    response = fetcher.call(lambda: client.connectapi(garmin_connect_user_settings_url), datetime.date.today(), limiter=limiter, endpoint="user_settings")
     print("Getting personal info")
+    personal_info = None
     if response is None or len(response) == 0:
         print("No personal info data")
     else:
@@ -463,6 +806,9 @@ def garmin_personal_info_to_personal_info_schema(response):
 
                 
 if __name__ == "__main__":
+    # plotly is only needed by the plot below
+    #pip install plotly
+    import plotly.graph_objects as go
     # # # # # # # # # client = authenticate(username, password)
     # # # # # # # # # today = datetime.date.today()
     # # # # # # # # # # # 2 years ago
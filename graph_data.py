@@ -4,18 +4,28 @@
 # from a dictionarry such as :{'BloodPressure': ['diastolic', 'pulse', 'systolic'], 'HeartRateMetrics': ['lastSevenDaysAvgRestingHeartRate', 'restingHeartRate'], 'RealTimeHeartRate': ['heartRateValue'], 'Sleep': ['averageRespirationValue', 'averageSpO2HRSleep', 'averageSpO2Value', 'avgSleepStress', 'awakeCount', 'awakeSleepSeconds', 'calendarDate', 'deepPercentage', 'deepSleepSeconds', 'highestRespirationValue', 'highestSpO2Value', 'lightPercentage', 'lightSleepSeconds', 'lowestRespirationValue', 'lowestSpO2Value', 'overallScore', 'remPercentage', 'remSleepSeconds', 'sleepEndTimestampLocal', 'sleepStartTimestampLocal', 'sleepTimeSeconds'], 'Weight': ['weight'], 'hrv': ['balancedLow', 'balancedUpper', 'lastNightAvg', 'weeklyAvg'], 'vo2max': ['vo2MaxPreciseValue']}
 #allow th user to select one or more measurements and one or more fields and plot them
 
-from dash import Dash, html, dcc, callback, Output, Input
+from dash import Dash, html, dcc, callback, ctx, no_update, Output, Input, State
+from flask import Response
 import plotly.express as px
 import pandas as pd
 import influxBackup as influxBackup
+import metrics
+import query
+import catalog
+import query_cache
+import rollups
+import storage
 from datetime import datetime, timedelta
 
 
 app = Dash(__name__)
 
-client = influxBackup.getInfuxClient()
-measurements = influxBackup.getListOfMeasurements(client)
-print(measurements)
+# InfluxDB unless garmin_storage selects another storage.BACKENDS entry
+backend = storage.getBackend()
+# the measurements and their fields are only read when the page is first loaded, and from disk while fresh
+measurements = catalog.Catalog(backend)
+# results of previous selections, shared on disk with the other dashboard processes
+results = query_cache.QueryCache(path=query_cache.CACHE_DIR)
 # create checkboxes for fields grouped by measurement on the left side of the page
 # create a graph on the right side of the page
 # when a checkbox is clicked, update the graph
@@ -28,10 +38,10 @@ app = Dash(__name__)
 # create a multi select dropdown for measurements
 # createa a multi select dropdown for fields which is populated based on the measurements selected
 app.layout = html.Div([
+    dcc.Location(id='url'),
     html.Div([
         dcc.Dropdown(
             id='measurement-dropdown',
-            options=[{'label': measurement, 'value': measurement} for measurement in measurements],
             multi=True,
             # set style to make the dropdown fill the entire width of the page
             style={'width': '100%'}
@@ -47,63 +57,73 @@ app.layout = html.Div([
             start_date=datetime.today().date() - timedelta(days=364),
             end_date=datetime.today().date() - timedelta(days=1)
 
+        ),
+        dcc.Checklist(
+            id='lttb-checklist',
+            options=[{'label': 'LTTB', 'value': 'lttb'}],
+            value=['lttb']
         )], # center elements and move them next to each other
              style={'display': 'flex', 'align-items': 'center', 'justify-content': 'center', 'width': '100%'}),
     dcc.Graph(id='graph'),
+    html.Div(id='resolution'),
 ])
 # convert dtatetime to date
 
+# set_measurement_options is called when the page is loaded
+@app.callback(
+    Output('measurement-dropdown', 'options'),
+    Input('url', 'pathname')
+)
+def set_measurement_options(pathname):
+    return [{'label': measurement, 'value': measurement} for measurement in measurements.get()]
+
 # set_field_options should be called when the measurements dropdown is changed
 @app.callback(
     Output('field-dropdown', 'options'),
     Input('measurement-dropdown', 'value')
 )
 def set_field_options(selected_measurements):
-    fields = []
-    for measurement in selected_measurements:
-        fields.extend(measurements[measurement])
+    fields = measurements.fields(selected_measurements or [])
     
     
     return [{'label': field, 'value': field} for field in fields]
 
 
-def populate_df(client, selected_measurements, selected_fields,start_date, stop_date):
-    
-    start = start_date.isoformat("T") + "Z"
-    stop = stop_date.isoformat("T") + "Z"
-    tables =  influxBackup.get(client, selected_measurements, selected_fields, start, stop)
-    data = {}
-    timestamps = {}
-    for table in tables:
-        sub_data = []
-        sub_timestamps = []
-        field = table.records[0].values["_field"]
-        for record in table.records:
-            sub_data.append(record.values["_value"])
-            sub_timestamps.append(record.values["_time"])
-        data[field] = sub_data
-        timestamps[field] = sub_timestamps
+def visibleRange(relayout):
+    """
+    Time range shown after a zoom, from the relayoutData of the graph
+
+    Returns:
+        (start, stop): UTC pandas Timestamps, None when the event is not a zoom
+    """
+    relayout = relayout or {}
+    if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+        x_range = [relayout['xaxis.range[0]'], relayout['xaxis.range[1]']]
+    elif 'xaxis.range' in relayout:
+        x_range = relayout['xaxis.range']
+    else:
+        return None
+    # plotly sends the times without a timezone, the traces are plotted in UTC
+    return tuple(pd.Timestamp(x).tz_localize('UTC') if pd.Timestamp(x).tzinfo is None else pd.Timestamp(x).tz_convert('UTC') for x in x_range)
+
+def figureFrames(figure):
+    """
+    DataFrames, one per trace, of the points already shown in the graph
+    """
     dfs = []
-    for field in data:
-        df = pd.DataFrame({"time": timestamps[field], field: data[field]})
-        df["time"] = pd.to_datetime(df["time"])
-        df = df.set_index("time")
-        df = df.sort_index()
-        dfs.append(df)
+    for trace in (figure or {}).get('data', []):
+        # px.line() starts the figure with an empty trace
+        if not trace.get('name') or 'x' not in trace:
+            continue
+        index = pd.DatetimeIndex(pd.to_datetime(trace.get('x', []), utc=True), name='time')
+        dfs.append(pd.DataFrame({trace['name']: trace.get('y', [])}, index=index))
     return dfs
 
-@app.callback(
-    Output('graph', 'figure'),
-    Input('measurement-dropdown', 'value'),
-    Input('field-dropdown', 'value'),
-    Input('date-picker-range', 'start_date'),
-    Input('date-picker-range', 'end_date')
-)
-def update_graph(selected_measurements, selected_fields, start_date, stop_date):
-    #convert 2023-11-29T14:48:32.833413 to datetime object datetime(2023, 11, 29, 14, 48, 32, 833413)
-    start_date = datetime.strptime(start_date, "%Y-%m-%d")
-    stop_date = datetime.strptime(stop_date, "%Y-%m-%d")
-    dfs = populate_df(client, selected_measurements, selected_fields, start_date, stop_date)
+def cacheSummary():
+    stats = results.stats()
+    return f"query cache: {stats['hit_rate']:.0%} hits, {stats['entries']} results, {stats['bytes'] / 1e6:.1f} MB"
+
+def buildFigure(dfs):
     fig = px.line()
     
     
@@ -153,7 +173,60 @@ def update_graph(selected_measurements, selected_fields, start_date, stop_date):
         )
     )
     return fig
+
+@app.callback(
+    Output('graph', 'figure'),
+    Output('resolution', 'children'),
+    Input('measurement-dropdown', 'value'),
+    Input('field-dropdown', 'value'),
+    Input('date-picker-range', 'start_date'),
+    Input('date-picker-range', 'end_date'),
+    Input('lttb-checklist', 'value'),
+    Input('graph', 'relayoutData'),
+    State('graph', 'figure')
+)
+def update_graph(selected_measurements, selected_fields, start_date, stop_date, lttb, relayout, figure):
+    #convert 2023-11-29T14:48:32.833413 to datetime object datetime(2023, 11, 29, 14, 48, 32, 833413)
+    start_date = datetime.strptime(start_date, "%Y-%m-%d")
+    stop_date = datetime.strptime(stop_date, "%Y-%m-%d")
+    # InfluxDB averages the points so that each field sends at most query.POINT_BUDGET points to the browser
+    lttb = 'lttb' in (lttb or [])
+    window = query.queryWindow(start_date, stop_date, query.POINT_BUDGET, lttb)
+    # only the InfluxDB queries are routed to the heart rate rollups
+    routed = backend.name == "influx"
+    rollup = rollups.rollupWindow(selected_measurements or [], selected_fields or [], window) if routed else None
+    resolution = f"Resolution: {query.describeResolution(window, lttb, rollup)}"
     
+    # the first load is a coarse overview of the whole range, zooming fetches only the visible
+    # range with the same point budget and merges it into the points already shown
+    if ctx.triggered_id == 'graph':
+        visible = visibleRange(relayout)
+        if visible is None:
+            # a reset of the zoom shows the overview again, other events (resizing...) change nothing
+            if not (relayout or {}).get('xaxis.autorange'):
+                return no_update, no_update
+        else:
+            start, stop = visible
+            details = backend.populate_df(selected_measurements, selected_fields, start, stop, points=query.POINT_BUDGET, lttb_pass=lttb, cache=results)
+            details = {df.columns[0]: df for df in details}
+            dfs = [query.mergeDetail(df, details.get(df.columns[0]), start, stop) for df in figureFrames(figure)]
+            fig = buildFigure(dfs)
+            fig.update_xaxes(range=[start, stop])
+            detail_window = query.queryWindow(start, stop, query.POINT_BUDGET, lttb)
+            detail_rollup = rollups.rollupWindow(selected_measurements, selected_fields, detail_window) if routed else None
+            return fig, f"{resolution}, visible range: {query.describeResolution(detail_window, lttb, detail_rollup)} ({cacheSummary()})"
+    
+    dfs = backend.populate_df(selected_measurements, selected_fields, start_date, stop_date, points=query.POINT_BUDGET, lttb_pass=lttb, cache=results)
+    return buildFigure(dfs), f"{resolution} ({cacheSummary()})"
+
+# query latency, rows and cache hit rates of the dashboard for Prometheus
+@app.server.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.registry.prometheus(), mimetype='text/plain')
+
+@app.server.route('/report')
+def metrics_report():
+    return metrics.registry.report()
 
 
 
@@ -1,13 +1,18 @@
 import influxdb_client, os, time
 from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.client.write_api import SYNCHRONOUS, ASYNCHRONOUS, WriteOptions, WriteType
 import pandas as pd
 from tqdm import tqdm
+from collections import deque
 
 from datetime import datetime, timedelta
 import plotly.graph_objects as go
 
+from influxdb_client.domain.dialect import Dialect
 from dotenv import load_dotenv
+import flux
+import metrics
+import query_cache
 
 load_dotenv()
 
@@ -16,6 +21,20 @@ org = "garmin_ws"
 url = "http://localhost:8086"
 bucket="garmin"
 
+# number of points sent to InfluxDB in a single write request
+BATCH_SIZE = 5000
+# "batching" writes in the background, "async" keeps a few requests in flight, "synchronous" waits for each batch.
+# async is the default because the bounded number of requests in flight holds back a streaming producer
+WRITE_MODE = "async"
+# milliseconds after which an incomplete batch is flushed in batching mode
+FLUSH_INTERVAL = 1000
+# number of async write requests allowed in flight at the same time
+MAX_PENDING = 8
+
+# nanoseconds in a calendar day, the times are local wall clock times read as UTC
+# so the UTC day of a point is the calendar day it was recorded on
+DAY = 24 * 60 * 60 * 1_000_000_000
+
 
 
 
@@ -52,30 +71,280 @@ def checkIfExists(client, data_point, bucket=bucket, org=org):
     else:
         return False
     
-def backupData(client, data, bucket=bucket, org=org):
-    write_api = client.write_api(write_options=SYNCHRONOUS)
-    #check if data already exists
+def toLineProtocol(data_point):
+    """
+    Convert a data point written with one of the garmin.py schemas to line protocol,
+    data points that are already encoded are returned as is
+    """
+    if isinstance(data_point, str):
+        return data_point
+    return Point.from_dict(data_point, write_precision=WritePrecision.NS).to_line_protocol()
+
+class DedupIndex:
+    """
+    (measurement, time) keys already stored in the bucket, loaded with one query per measurement
+    so that duplicate points are dropped before writing at the cost of a set lookup.
+
+    Only the points of a measurement older than the stop of its load are checked, the newer ones
+    are always written so that the corrections of recent days replace the stored points.
+    """
+    def __init__(self):
+        self.keys = {}
+        self.stops = {}
+        self.skipped = 0
+
+    def load(self, client, measurement, start, stop, bucket=bucket, org=org):
+        """
+        Args:
+            client: InfluxDB client
+            measurement: name of the measurement
+            start: datetime.date or datetime.datetime object
+            stop: datetime.date or datetime.datetime object, the points from stop on are not deduplicated
+        """
+        query = f'from(bucket: "{bucket}")\
+            |> range(start: {flux.fluxTime(start)}, stop: {flux.fluxTime(stop)})\
+            |> filter(fn: (r) => r._measurement == "{measurement}")\
+            |> keep(columns: ["_time"])\
+            |> group()\
+            |> unique(column: "_time")'
+        # read as CSV, a FluxRecord per point is several times slower for the millions of heart rate samples
+        dialect = Dialect(header=True, annotations=[], date_time_format="RFC3339")
+        response = client.query_api().query_raw(query, org=org, dialect=dialect)
+        try:
+            times = pd.read_csv(response, usecols=["_time"])["_time"]
+        except (pd.errors.EmptyDataError, ValueError):
+            times = pd.Series([], dtype="string")
+        finally:
+            response.close()
+        keys = flux.parseTimes(times).values.astype("int64")
+        self.keys.setdefault(measurement, set()).update(keys.tolist())
+        self.stops[measurement] = pd.Timestamp(flux.fluxTime(stop)).value
+        print(f"Loaded {len(keys)} existing {measurement} points for deduplication")
+        return self
+
+    def isNew(self, line):
+        """
+        True if the line protocol point is not in the bucket yet or is not checked, a checked point
+        is then added to the index
+        """
+        measurement, key = _lineKey(line)
+        if key is None or key >= self.stops.get(measurement, 0):
+            return True
+        keys = self.keys.setdefault(measurement, set())
+        if key in keys:
+            self.skipped += 1
+            return False
+        keys.add(key)
+        return True
+
+def _lineKey(line):
+    # measurement and timestamp of a line of line protocol, the timestamp is None when the point has none
+    measurement = line.split(" ", 1)[0].split(",", 1)[0]
+    timestamp = line.rsplit(" ", 1)[-1]
+    # a string field value always ends with a quote so only a timestamp can be made of digits only
+    if not timestamp.lstrip("-").isdigit():
+        return measurement, None
+    return measurement, int(timestamp)
+
+def _day(line):
+    # calendar day of a line of line protocol in days since 1970-01-01, None without a timestamp
+    timestamp = line.rsplit(" ", 1)[-1]
+    return int(timestamp) // DAY if timestamp.isdigit() else None
+
+def batches(data, batch_size=BATCH_SIZE, dedup=None, written=None, days=None):
+    """
+    Group an iterable of data points, or of lists of data points such as the per-day chunks
+    yielded by the garmin.py iter_* collectors, into lists of at most batch_size lines of line protocol
+
+    Points already in the DedupIndex dedup are left out, the measurements of the other
+    points are added to the set written and their days to the dictionary days of measurement: set of days
+    """
+    batch = []
+    skipped = 0
+    for data_point in data:
+        chunk = data_point if isinstance(data_point, list) else [data_point]
+        for data_point in chunk:
+            line = toLineProtocol(data_point)
+            # points whose fields are all None have nothing to write
+            if not line:
+                continue
+            if dedup is not None and not dedup.isNew(line):
+                skipped += 1
+                continue
+            if written is not None or days is not None:
+                measurement = line.split(" ", 1)[0].split(",", 1)[0]
+                if written is not None:
+                    written.add(measurement)
+                if days is not None:
+                    day = _day(line)
+                    if day is not None:
+                        days.setdefault(measurement, set()).add(day)
+            batch.append(line)
+            if len(batch) >= batch_size:
+                # counted once per batch, a lock per point would slow the transform down
+                metrics.inc("points_transformed_total", len(batch) + skipped)
+                metrics.inc("points_skipped_total", skipped)
+                yield batch
+                batch = []
+                skipped = 0
+    metrics.inc("points_transformed_total", len(batch) + skipped)
+    metrics.inc("points_skipped_total", skipped)
+    if batch:
+        yield batch
+
+def backupData(client, data, bucket=bucket, org=org, batch_size=BATCH_SIZE, mode=WRITE_MODE, dedup=None, days=None):
+    """
+    Write data points to InfluxDB in batches
+
+    Args:
+        client: InfluxDB client
+        data: list or generator of data points using the garmin.py schemas or line protocol strings,
+              or of per-day lists of them
+        batch_size: number of points per write request
+        mode: "batching", "async" or "synchronous"
+        dedup: optional DedupIndex, points already in the bucket are not written again
+        days: optional dictionary filled with measurement: set of the days of the points written
+    Returns:
+        count: number of points written
+    """
+    if data is None:
+        print("No data to back up")
+        return 0
+    errors = []
+    def on_error(conf, lines, exception):
+        errors.append(exception)
+        print(f"Failed to write batch: {exception}")
+    def on_retry(conf, lines, exception):
+        print(f"Retrying batch: {exception}")
+
+    if mode == "batching":
+        write_options = WriteOptions(write_type=WriteType.batching, batch_size=batch_size, flush_interval=FLUSH_INTERVAL)
+        write_api = client.write_api(write_options=write_options, error_callback=on_error, retry_callback=on_retry)
+    elif mode == "async":
+        write_api = client.write_api(write_options=ASYNCHRONOUS)
+    else:
+        write_api = client.write_api(write_options=SYNCHRONOUS)
+
     print("Backing up data")
-    for data_point in tqdm(data):
-        write_api.write(bucket, org, data_point)
-        # dataPointExists = checkIfExists(client, data_point)
-        # if not dataPointExists:
-        #     write_api.write(bucket, org, data_point)
-        # else:
-        #     print("Data point already exists")
+    pending = deque()
+    count = 0
+    written = set()
+    start_time = time.perf_counter()
+    try:
+        with tqdm(unit=" points") as progress:
+            for batch in batches(data, batch_size, dedup, written, days):
+                # in batching mode this only measures handing the batch over to the background writer
+                with metrics.timer("write_seconds", backend="influx"):
+                    result = write_api.write(bucket, org, batch, write_precision=WritePrecision.NS)
+                metrics.inc("points_written_total", len(batch), backend="influx")
+                if mode == "async":
+                    pending.append(result)
+                    if len(pending) > MAX_PENDING:
+                        pending.popleft().get()
+                count += len(batch)
+                progress.update(len(batch))
+            while pending:
+                pending.popleft().get()
+    finally:
+        # flushes whatever is still buffered in batching mode
+        write_api.close()
+        # cached dashboard queries of recent data of these measurements are out of date
+        query_cache.markWritten(written)
+    elapsed = time.perf_counter() - start_time
+    print(f"Wrote {count} points in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} points/sec)")
+    if dedup is not None:
+        print(f"{dedup.skipped} duplicate points skipped so far")
+    if errors:
+        raise errors[0]
+    return count
 
-def getListOfMeasurements(client, bucket=bucket, org=org):
+def getLastTimestamps(client, measurements, bucket=bucket, org=org):
+    """
+    Get the time of the most recent point of each measurement in a single query
+
+    Args:
+        client: InfluxDB client
+        measurements: list of measurement names
+    Returns:
+        last_timestamps: dictionary of measurement -> datetime of its latest point,
+                         measurements without any data are missing from the dictionary
+    """
     query_api = client.query_api()
     query = f'from(bucket: "{bucket}")\
-        |> range(start: 0)'
-    tables = query_api.query(query)
-    data = {}
+        |> range(start: 0)\
+        |> filter(fn: (r) => {flux.anyOf("_measurement", measurements)})\
+        |> last()\
+        |> group(columns: ["_measurement"])\
+        |> max(column: "_time")'
+    tables = query_api.query(query, org=org)
+    last_timestamps = {}
     for table in tables:
-        measurement = table.records[0].values["_measurement"]
-        field = table.records[0].values["_field"]
-        if measurement not in data:
-            data[measurement] = []
-        data[measurement].append(field)
+        for record in table.records:
+            last_timestamps[record.get_measurement()] = record.get_time()
+    return last_timestamps
+
+def getFirstTimestamps(client, measurements, bucket=bucket, org=org):
+    """
+    Get the time of the oldest point of each measurement in a single query, see getLastTimestamps
+    """
+    query_api = client.query_api()
+    query = f'from(bucket: "{bucket}")\
+        |> range(start: 0)\
+        |> filter(fn: (r) => {flux.anyOf("_measurement", measurements)})\
+        |> first()\
+        |> group(columns: ["_measurement"])\
+        |> min(column: "_time")'
+    tables = query_api.query(query, org=org)
+    first_timestamps = {}
+    for table in tables:
+        for record in table.records:
+            first_timestamps[record.get_measurement()] = record.get_time()
+    return first_timestamps
+
+def getDays(client, measurements, bucket=bucket, org=org):
+    """
+    Calendar days holding at least one point of each measurement, in a single aggregate query
+    counting the points of every day
+
+    Returns:
+        days: dictionary of measurement: numpy array of days since 1970-01-01
+    """
+    query = f'from(bucket: "{bucket}")\
+        |> range(start: 0)\
+        |> filter(fn: (r) => {flux.anyOf("_measurement", measurements)})\
+        |> aggregateWindow(every: 1d, fn: count, createEmpty: false, timeSrc: "_start")\
+        |> keep(columns: ["_measurement", "_time"])\
+        |> group(columns: ["_measurement"])\
+        |> unique(column: "_time")'
+    dialect = Dialect(header=True, annotations=[], date_time_format="RFC3339")
+    response = client.query_api().query_raw(query, org=org, dialect=dialect)
+    try:
+        df = pd.read_csv(response, usecols=["_measurement", "_time"])
+    except (pd.errors.EmptyDataError, ValueError):
+        return {}
+    finally:
+        response.close()
+    df["_time"] = flux.parseTimes(df["_time"])
+    df["day"] = df["_time"].values.astype("datetime64[D]").astype("int64")
+    return {measurement: group["day"].unique() for measurement, group in df.groupby("_measurement")}
+
+def getListOfMeasurements(client, bucket=bucket, org=org):
+    """
+    Measurements of the bucket and their fields, read from the schema metadata
+    instead of scanning every point of the bucket
+
+    Returns:
+        data: dictionary of measurement: list of field names
+    """
+    query_api = client.query_api()
+    query = f'import "influxdata/influxdb/schema"\n\
+        schema.measurements(bucket: "{bucket}", start: 0)'
+    measurements = [record.get_value() for table in query_api.query(query, org=org) for record in table.records]
+    data = {}
+    for measurement in sorted(measurements):
+        query = f'import "influxdata/influxdb/schema"\n\
+            schema.measurementFieldKeys(bucket: "{bucket}", measurement: "{measurement}", start: 0)'
+        data[measurement] = sorted(record.get_value() for table in query_api.query(query, org=org) for record in table.records)
     return data
 
 def get(client, measurements, fields, startDate, stopDate, bucket=bucket, org=org):
@@ -96,33 +365,10 @@ def get(client, measurements, fields, startDate, stopDate, bucket=bucket, org=or
     tables = query_api.query(query)
     return tables
 
-def populate_df(client, selected_measurements, selected_fields,start, stop):
-    
-    start = start.isoformat("T") + "Z"
-    stop = stop.isoformat("T") + "Z"
-    tables =  get(client, selected_measurements, selected_fields, start, stop)
-    data = {}
-    timestamps = {}
-    for table in tables:
-        sub_data = []
-        sub_timestamps = []
-        field = table.records[0].values["_field"]
-        for record in table.records:
-            sub_data.append(record.values["_value"])
-            sub_timestamps.append(record.values["_time"])
-        data[field] = sub_data
-        timestamps[field] = sub_timestamps
-    dfs = []
-    for field in data:
-        df = pd.DataFrame({"time": timestamps[field], field: data[field]})
-        df["time"] = pd.to_datetime(df["time"])
-        df = df.set_index("time")
-        df = df.sort_index()
-        dfs.append(df)
-    return dfs
-
             
 if __name__ == "__main__":
+    # the query and DataFrame conversion live in query.py, which imports this module
+    import query
     client = getInfuxClient()
     # start = datetime.datetime(2021, 1, 1, 0, 0, 0, 0).isoformat("T") + "Z"
     # stop = datetime.datetime.now().isoformat("T") + "Z"
@@ -160,7 +406,7 @@ if __name__ == "__main__":
     #     df = df.sort_index()
     #     dfs.append(df)
     
-    dfs = populate_df(client, ["HeartRateMetrics", "BloodPressure"], ["restingHeartRate", "systolic", "diastolic"], start, stop)
+    dfs = query.populate_df(client, ["HeartRateMetrics", "BloodPressure"], ["restingHeartRate", "systolic", "diastolic"], start, stop)
         
     #plot the data
     fig = go.Figure()
@@ -0,0 +1,191 @@
+import argparse
+import datetime
+import os
+import sqlite3
+import threading
+import time
+import response_cache
+
+# progress of the backfills, kept apart from the caches so that clearing them does not lose it
+JOURNAL_FILE = os.environ.get("garmin_journal_file", "garmin_journal.sqlite")
+DONE = "done"
+EMPTY = "empty"
+FAILED = "failed"
+# measurements written by every source of the garmin.py collectors, a day of a source is in the
+# store when one of its measurements has a point that day
+SOURCE_MEASUREMENTS = {
+    "hr": ["HeartRateMetrics", "RealTimeHeartRate"],
+    "hr_data": ["RealTimeHeartRate"],
+    "hr_related": ["HeartRateMetrics"],
+    "hrv": ["hrv"],
+    "weight": ["Weight"],
+    "vo2max": ["vo2max"],
+    "sleep": ["Sleep"],
+}
+
+
+def _date(date):
+    return date if isinstance(date, datetime.date) and not isinstance(date, datetime.datetime) else date.date()
+
+class Journal:
+    """
+    Progress of every source day by day: (source, date, status, point count), with status
+    done when the points of the day were handed to the write path, empty when Garmin had no
+    data for the day and failed when the requests of the day failed.
+
+    A day is complete when it is done or empty and was recorded once the day was settled,
+    pending lists the other days so that a crashed backfill resumes where it stopped. The days
+    a daily run records before they settle are unsettled, revisit finds them once they have
+    settled so that the next run fetches them a last time.
+
+    With a day_coverage.Coverage of the store, the store decides for the days the journal does
+    not hold as complete: a day with points is complete unless the journal recorded it before it
+    settled or as failed, and a day without points is pending unless the journal knows it is empty.
+    Holes in the middle of the history are then fetched again, and the days backed up before the
+    journal existed are not.
+    """
+    def __init__(self, path=JOURNAL_FILE, settle_days=response_cache.SETTLE_DAYS, coverage=None):
+        self.path = path
+        self.settle_days = settle_days
+        self.coverage = coverage
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS days (source TEXT NOT NULL, date TEXT NOT NULL, status TEXT NOT NULL, "
+                                    "count INTEGER NOT NULL, updated REAL NOT NULL, PRIMARY KEY (source, date)) WITHOUT ROWID")
+
+    def _mark(self, source, date, status, count):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?)",
+                                    (source, _date(date).isoformat(), status, count, time.time()))
+
+    def done(self, source, date, count):
+        self._mark(source, date, DONE, count)
+
+    def empty(self, source, date):
+        self._mark(source, date, EMPTY, 0)
+
+    def failed(self, source, date):
+        self._mark(source, date, FAILED, 0)
+
+    def days(self, source, start_date=None, stop_date=None):
+        """
+        Returns:
+            days: dictionary of datetime.date: (status, count, updated) of the recorded days of source
+        """
+        sql = "SELECT date, status, count, updated FROM days WHERE source = ?"
+        parameters = [source]
+        if start_date is not None:
+            sql += " AND date >= ?"
+            parameters.append(_date(start_date).isoformat())
+        if stop_date is not None:
+            sql += " AND date <= ?"
+            parameters.append(_date(stop_date).isoformat())
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        return {datetime.date.fromisoformat(date): (status, count, updated) for date, status, count, updated in rows}
+
+    def _settled(self, date, entry):
+        # a day recorded before it settled may still get data from the watch
+        recorded = datetime.date.fromtimestamp(entry[2])
+        return recorded >= date + datetime.timedelta(days=self.settle_days)
+
+    def _complete(self, date, entry, stored=None):
+        if stored is None:
+            return entry is not None and entry[0] != FAILED and self._settled(date, entry)
+        if stored:
+            if entry is None:
+                # backed up without the journal, complete unless it may still change
+                return date <= datetime.date.today() - datetime.timedelta(days=self.settle_days)
+            return entry[0] != FAILED and self._settled(date, entry)
+        # no point in the store: only a day known to be empty since it settled is complete
+        return entry is not None and entry[0] == EMPTY and self._settled(date, entry)
+
+    def _stored(self, source, dates):
+        if self.coverage is None or source not in SOURCE_MEASUREMENTS:
+            return [None] * len(dates)
+        stored = [False] * len(dates)
+        for measurement in SOURCE_MEASUREMENTS[source]:
+            missing = set(self.coverage.missing(measurement, min(dates), max(dates)))
+            stored = [was or date not in missing for was, date in zip(stored, dates)]
+        return stored
+
+    def pending(self, source, dates):
+        """
+        The dates of a source that are not complete yet, in the same order
+        """
+        dates = [_date(date) for date in dates]
+        if not dates:
+            return []
+        days = self.days(source, min(dates), max(dates))
+        stored = self._stored(source, dates)
+        return [date for date, in_store in zip(dates, stored) if not self._complete(date, days.get(date), in_store)]
+
+    def revisit(self, source, start_date, stop_date):
+        """
+        First day of source between start_date and stop_date that has settled since it was recorded
+        before settling, or that failed, None when there is none
+        """
+        settled = datetime.date.today() - datetime.timedelta(days=self.settle_days)
+        days = self.days(source, start_date, min(_date(stop_date), settled))
+        return min((date for date, entry in days.items() if not self._complete(date, entry)), default=None)
+
+    def sources(self):
+        with self.lock:
+            return [source for (source,) in self.connection.execute("SELECT DISTINCT source FROM days ORDER BY source")]
+
+    def status(self, start_date, stop_date, sources=None):
+        """
+        Coverage of every source between start_date and stop_date
+
+        Returns:
+            status: dictionary of source: dictionary with the number of done, empty, failed, unsettled
+                    and pending days, the points recorded and the list of failed dates. Unsettled days
+                    were recorded as done or empty before they settled and are not counted as pending
+        """
+        dates = [start_date + datetime.timedelta(days=i) for i in range((stop_date - start_date).days + 1)]
+        status = {}
+        for source in sources or self.sources():
+            days = self.days(source, start_date, stop_date)
+            entries = [days.get(date) for date in dates]
+            pending = set(self.pending(source, dates))
+            unsettled = sum(1 for date, entry in zip(dates, entries)
+                            if date in pending and entry is not None and entry[0] != FAILED and not self._settled(date, entry))
+            status[source] = {
+                DONE: sum(1 for entry in entries if entry is not None and entry[0] == DONE),
+                EMPTY: sum(1 for entry in entries if entry is not None and entry[0] == EMPTY),
+                FAILED: sum(1 for entry in entries if entry is not None and entry[0] == FAILED),
+                "unsettled": unsettled,
+                "pending": len(pending) - unsettled,
+                "points": sum(entry[1] for entry in entries if entry is not None),
+                "failed_dates": [date for date, entry in zip(dates, entries) if entry is not None and entry[0] == FAILED],
+            }
+        return status
+
+    def close(self):
+        self.connection.close()
+
+def printStatus(status, start_date, stop_date):
+    days = (stop_date - start_date).days + 1
+    print(f"Coverage from {start_date} to {stop_date} ({days} days)")
+    print(f"{'source':<16}{'done':>8}{'empty':>8}{'failed':>8}{'unsettled':>11}{'pending':>9}{'points':>12}{'coverage':>10}")
+    for source, counts in status.items():
+        coverage = (days - counts["pending"]) / days if days else 1.0
+        print(f"{source:<16}{counts[DONE]:>8}{counts[EMPTY]:>8}{counts[FAILED]:>8}{counts['unsettled']:>11}{counts['pending']:>9}{counts['points']:>12}{coverage:>10.0%}")
+    for source, counts in status.items():
+        if counts["failed_dates"]:
+            print(f"{source} failed on {', '.join(date.isoformat() for date in counts['failed_dates'][:20])}"
+                  + (" ..." if len(counts["failed_dates"]) > 20 else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the progress of the backfills recorded in the journal")
+    parser.add_argument("--days", type=int, default=365, help="number of days up to yesterday covered by the report")
+    parser.add_argument("--source", action="append", default=None, help="only report this source, can be repeated")
+    args = parser.parse_args()
+    stop_date = datetime.date.today() - datetime.timedelta(days=1)
+    start_date = stop_date - datetime.timedelta(days=args.days - 1)
+    progress = Journal()
+    printStatus(progress.status(start_date, stop_date, args.source), start_date, stop_date)
+    progress.close()
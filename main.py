@@ -1,71 +1,235 @@
 import garmin as garmin
 import influxBackup as influxBackup
+import response_cache
+import pipeline
+import rollups
+import parquet_store
+import storage
+import metrics
+import spool
+import journal
+import day_coverage
 import datetime
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 import time
+import argparse
 
-def readLocalHR():
-    df = pd.read_parquet("heartrate.parquet")
-    df["time"] = pd.to_datetime(df["time"])
-    df = df.set_index("time")
-    df = df.sort_index()
-    return df
+def readLocalHR(start_date=None, stop_date=None, store=None):
+    # intraday heart rate from the local Parquet store, only the months in range are read
+    store = store or parquet_store.ParquetStore()
+    df = store.read("RealTimeHeartRate", ["heartRateValue"], start_date, stop_date)
+    return df.rename(columns={"heartRateValue": "heartrate"})
 
 
-def writeHRToParquet(client, start_date, stop_date):
-    tables = influxBackup.getMeasurement(client, "real_time_heart_rate", "heartRateValue", start_date, stop_date)
-    #move to pandas dataframe
-    heartrates = [record.values["_value"] for record in tables[0].records]
-    time = [record.values["_time"] for record in tables[0].records]
-    df = pd.DataFrame({"time": time, "heartrate": heartrates})
-    #write to parquet
-    df.to_parquet("heartrate.parquet")
-    
+def writeHRToParquet(client, start_date, stop_date, store=None):
+    # appends the intraday heart rate newer than what the local Parquet store already holds
+    store = store or parquet_store.ParquetStore()
+    return store.sync(client, {"RealTimeHeartRate": ["heartRateValue"]}, start_date, stop_date)
+    
+def syncStart(last_timestamps, measurements, start_date, overlap):
+    """
+    First day to fetch for a source so that only data newer than what is already in InfluxDB is downloaded
+
+    Args:
+        last_timestamps: dictionary returned by influxBackup.getLastTimestamps
+        measurements: list of the measurements written by the source
+        start_date: datetime.date used when one of the measurements has no data yet
+        overlap: number of days fetched again before the latest point to catch late-arriving data
+    Returns:
+        start_date: datetime.date object
+    """
+    if any(measurement not in last_timestamps for measurement in measurements):
+        return start_date
+    last = min(last_timestamps[measurement] for measurement in measurements)
+    return last.date() - datetime.timedelta(days=overlap)
+
+def fetchStart(last_timestamps, source, measurements, start_date, stop_date, overlap, progress=None):
+    """
+    First day fetched by a source: syncStart, or the first day the journal recorded before it
+    settled when that is earlier, the days in between are complete and skipped by the collectors
+
+    Args:
+        source: name of the source in the journal, None for the sources without one
+        progress: optional journal.Journal
+    Returns:
+        start_date: datetime.date object
+    """
+    sync_start = syncStart(last_timestamps, measurements, start_date, overlap)
+    if progress is None or source is None:
+        return sync_start
+    revisit = progress.revisit(source, start_date, stop_date)
+    return sync_start if revisit is None else min(revisit, sync_start)
     
 
 
 
     
+def buildStages(garmin_client, start_date, stop_date, last_timestamps, overlap, cache, progress=None):
+    """
+    One pipeline.Stage per source, each starting at the latest point of its measurements
+
+    Args:
+        garmin_client: Garmin client
+        start_date: datetime.date used by the sources without data yet
+        stop_date: datetime.date object
+        last_timestamps: dictionary returned by influxBackup.getLastTimestamps
+        overlap: number of days fetched again before the latest point
+        cache: response_cache.ResponseCache holding the raw responses
+        progress: optional journal.Journal, the days it holds as complete are not fetched again and
+                  the days it recorded before they settled are fetched once more after settling
+    Returns:
+        stages: list of pipeline.Stage
+    """
+    def start(source, *measurements):
+        return fetchStart(last_timestamps, source, list(measurements), start_date, stop_date, overlap, progress)
+    # the iter_* collectors yield one day at a time so that writing overlaps with fetching
+    # and only a few days of data are held in memory
+    def hr(limiter):
+        data = garmin.iter_all_hr_data(garmin_client, start("hr", "HeartRateMetrics", "RealTimeHeartRate"), stop_date, limiter=limiter, cache=cache, line_protocol=True, journal=progress)
+        return (hr_related_data + hr_data for hr_related_data, hr_data in data)
+    return [
+        pipeline.Stage("hr", hr),
+        pipeline.Stage("hrv", lambda limiter: garmin.iter_hrv_data(garmin_client, start("hrv", "hrv"), stop_date, limiter=limiter, cache=cache, journal=progress)),
+        pipeline.Stage("weight", lambda limiter: garmin.iter_weight(garmin_client, start("weight", "Weight"), stop_date, limiter=limiter, cache=cache, journal=progress)),
+        pipeline.Stage("vo2max", lambda limiter: garmin.iter_VO2Max(garmin_client, start("vo2max", "vo2max"), stop_date, limiter=limiter, cache=cache, journal=progress)),
+        pipeline.Stage("blood_pressure", lambda limiter: garmin.get_blood_pressures(garmin_client, start(None, "BloodPressure"), stop_date, limiter=limiter)),
+        pipeline.Stage("sleep", lambda limiter: garmin.iter_garmin_sleep_data(garmin_client, start("sleep", "Sleep"), stop_date, limiter=limiter, cache=cache, journal=progress)),
+        pipeline.Stage("activities", lambda limiter: garmin.iter_activities(garmin_client, start(None, "Activity"), stop_date, limiter=limiter)),
+        pipeline.Stage("personal_info", lambda limiter: garmin.get_personal_info(garmin_client, limiter=limiter)),
+    ]
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Back up Garmin Connect data to InfluxDB or an embedded database")
+    parser.add_argument("--full", action="store_true", help="fetch the whole window instead of syncing from the latest point in InfluxDB")
+    parser.add_argument("--days", type=int, default=365, help="number of days fetched by a full backfill")
+    parser.add_argument("--overlap", type=int, default=2, help="number of days fetched again before the latest point of each measurement")
+    parser.add_argument("--no-dedup", action="store_true", help="write every fetched point even if it is already in InfluxDB")
+    parser.add_argument("--parallel", type=int, default=None, help="number of sources backed up at the same time, all of them by default")
+    parser.add_argument("--parquet", action="store_true", help="append the new points of every measurement to the local Parquet store")
+    parser.add_argument("--storage", choices=sorted(storage.BACKENDS), default=storage.STORAGE, help="where the data is backed up, InfluxDB by default")
+    parser.add_argument("--metrics", action="store_true", help=f"serve the metrics of the run in the Prometheus format on port {metrics.PORT}")
+    parser.add_argument("--report", default=None, help="file of the JSON run report, written under the report directory by default")
+    parser.add_argument("--no-spool", action="store_true", help="write the fetched points straight to the storage backend instead of spooling them on disk first")
+    parser.add_argument("--no-journal", action="store_true", help="fetch every day again even if the journal holds it as complete, and do not record progress")
+    parser.add_argument("--status", action="store_true", help="report the progress recorded in the journal over the last --days days and exit")
+    parser.add_argument("--gaps", action="store_true", help="fetch the days of the last --days days missing from the store instead of syncing from the latest point")
+    args = parser.parse_args()
+    if args.gaps and args.no_journal:
+        parser.error("--gaps needs the journal to tell the days without data apart from the days not fetched yet")
+    if args.no_spool and not args.no_journal:
+        # the batches handed to the storage backend are acknowledged long after the collectors
+        # move on to the next day, a crash would leave days in the journal that were never written
+        parser.error("--no-spool needs --no-journal, only the spool acknowledges a day once it is on disk")
+    
+    if args.metrics:
+        metrics.serve()
     
     today = datetime.date.today()
-    start_date = today - datetime.timedelta(days=365)
+    start_date = today - datetime.timedelta(days=args.days)
     stop_date  = today - datetime.timedelta(days=1)
     
+    # days already backed up by an earlier, possibly interrupted, run are skipped
+    progress = None if args.no_journal else journal.Journal()
+    if args.status:
+        journal.printStatus((progress or journal.Journal()).status(start_date, stop_date), start_date, stop_date)
+        raise SystemExit(0)
+    
     # Authenticate with Garmin Connect
     garmin_client = garmin.authenticate(garmin.username, garmin.password)
-    
-    influxdb_client = influxBackup.getInfuxClient()
-    
-    hr_data = garmin.get_hr_related_data(garmin_client, start_date, stop_date)
-    influxBackup.backupData(influxdb_client, hr_data)
-    
-    hr_data = garmin.get_hr_data(garmin_client, start_date, stop_date)
-    influxBackup.backupData(influxdb_client, hr_data)
-    
-    data = garmin.get_hrv_data(garmin_client, start_date, stop_date)
-    influxBackup.backupData(influxdb_client, data)
-    
-    data = garmin.get_weight(garmin_client, start_date, stop_date)
-    influxBackup.backupData(influxdb_client, data)
-
-    data = garmin.get_VO2Max(garmin_client, start_date, stop_date)
-    influxBackup.backupData(influxdb_client, data)
-
-    data = garmin.get_blood_pressures(garmin_client, start_date, stop_date)
-    influxBackup.backupData(influxdb_client, data)
-
-    data = garmin.get_garmin_sleep_data(garmin_client, start_date, stop_date)
-    influxBackup.backupData(influxdb_client, data)
-    
-    data = garmin.get_personal_info(garmin_client)
-    influxBackup.backupData(influxdb_client, data)
-    
-    # writeHRToParquet(influxdb_client, start_date, stop_date)
-    
-    influxdb_client.close()
+    if garmin_client is None:
+        raise SystemExit("Could not log in to Garmin Connect")
+    
+    backend = storage.getBackend(args.storage)
+    # days holding points of every measurement, kept up to date by the writes once it has been built
+    backend.coverage = day_coverage.Coverage(backend)
+    if args.gaps:
+        # one aggregate query when there is no coverage on disk yet
+        backend.coverage.load()
+        progress.coverage = backend.coverage
+    if backend.name == "influx":
+        # the heart rate days of every write are rolled up after the run, including those of the spool below
+        backend.on_write = rollups.addPending
+    
+    # points fetched by a previous run that could not be written go first, so that the latest
+    # timestamps below include them and their days are not downloaded again
+    wal = None
+    if not args.no_spool:
+        wal = spool.Spool()
+        wal.recover()
+        if wal.segments():
+            print(f"Writing the {wal.pending()} points spooled by a previous run")
+            try:
+                wal.drain(backend)
+            except Exception as err:
+                raise SystemExit(f"Storage backend unavailable ({err}), the spooled points are kept in {wal.path}")
+    
+    # raw Garmin responses are kept on disk so that settled days are never downloaded twice
+    cache = response_cache.ResponseCache()
+    
+    # high-water mark of every measurement, an empty dictionary makes every source fetch the whole window
+    measurements = ["HeartRateMetrics", "RealTimeHeartRate", "hrv", "Weight", "vo2max", "BloodPressure", "Sleep", "Activity"]
+    last_timestamps = {}
+    if not args.full and not args.gaps:
+        last_timestamps = backend.getLastTimestamps(measurements)
+    
+    # with --full or --gaps the points already in the bucket are loaded once and skipped when writing,
+    # for every measurement only for the settled days before its overlap: the points of the overlap
+    # and of recent days are written again so that late corrections replace the stored ones.
+    # An incremental run starts every source at its overlap so there is nothing to load then.
+    # The window starts a day early because the times are local.
+    # The embedded backends replace points in place so writing them again costs little
+    dedup = None
+    if not args.no_dedup and backend.name == "influx" and not last_timestamps:
+        stored = backend.getLastTimestamps(measurements)
+        settled = today - datetime.timedelta(days=response_cache.SETTLE_DAYS)
+        for measurement in measurements:
+            if measurement not in stored:
+                continue
+            window_stop = min(stored[measurement].date() - datetime.timedelta(days=args.overlap), settled)
+            if start_date < window_stop:
+                if dedup is None:
+                    dedup = influxBackup.DedupIndex()
+                dedup.load(backend.client, measurement, start_date - datetime.timedelta(days=1), window_stop)
+    write = lambda backend, data: backend.backupData(data, dedup=dedup)
+    drainer = None
+    if wal is not None:
+        # the stages only append to the spool, a background drainer writes the sealed segments
+        # so that a slow or unavailable storage backend never loses what was fetched
+        drainer = spool.Drainer(wal, backend).start()
+        write = lambda backend, data: wal.append(data, dedup=dedup)
+    
+    # every source runs as its own stage, the stages share the default request budget
+    stages = buildStages(garmin_client, start_date, stop_date, last_timestamps, args.overlap, cache, progress)
+    pipeline.run_stages(stages, backend, max_parallel=args.parallel, write=write)
+    written = True
+    if drainer is not None:
+        drainer.stop()
+        if drainer.error is not None:
+            written = False
+            print(f"{wal.pending()} points are kept in {wal.path} and will be written by the next run")
+    stage_results = [{"stage": stage.name, "requests": stage.requests, "points": stage.points, "seconds": stage.seconds,
+                      "error": None if stage.error is None else str(stage.error)} for stage in stages]
+    
+    if backend.name == "influx" and written:
+        # hourly, daily and weekly heart rate rollups of the weeks written to since they were last computed,
+        # used by the dashboard for long ranges
+        rollups.updatePending(backend.client)
+        # the history backed up before the rollups existed, the dashboard reads long ranges from them
+        rollups.backfill(backend.client)
+        
+        if args.parquet:
+            store = parquet_store.ParquetStore()
+            store.sync(backend.client, backend.getListOfMeasurements(), start_date, today)
+    
+    backend.close()
+    if progress is not None:
+        progress.close()
+    
+    # where the run spent its time: request latencies per endpoint, 429s, write and query latencies, cache hit rates
+    report = metrics.writeReport(args.report, extra={"stages": stage_results, "login_seconds": garmin.login_latency})
+    print(f"Run report written to {report}")
     
     
     # #calculate the time it takes to run the script
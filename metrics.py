@@ -0,0 +1,252 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import datetime
+import json
+import os
+import threading
+import time
+
+# upper bounds of the buckets of the latency histograms (seconds)
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+# where main.py writes the JSON report of every run
+REPORT_DIR = os.environ.get("garmin_report_dir", os.path.join(os.environ.get("garmin_cache_dir", ".garmin_cache"), "reports"))
+# port of the Prometheus endpoint served by main.py --metrics
+PORT = int(os.environ.get("garmin_metrics_port", 9464))
+PREFIX = "garmin_"
+
+HELP = {
+    "requests_total": "Requests sent to Garmin Connect",
+    "request_seconds": "Latency of the requests to Garmin Connect",
+    "request_errors_total": "Requests to Garmin Connect that failed for good",
+    "rate_limited_total": "Requests answered with a 429",
+    "retries_total": "Requests sent again after a 429",
+    "cache_lookups_total": "Lookups of the response and query caches by result",
+    "points_transformed_total": "Points converted to line protocol",
+    "points_skipped_total": "Points left out because they are already stored",
+    "points_written_total": "Points written to the storage backend",
+    "write_seconds": "Latency of the writes of a batch to the storage backend",
+    "query_seconds": "Latency of the queries of the storage backend",
+    "query_rows_total": "Rows returned by the queries of the storage backend",
+    "stage_points": "Points written by the last run of a stage",
+    "stage_seconds": "Duration of the last run of a stage",
+    "stage_requests": "Requests made by the last run of a stage",
+    "spool_points_total": "Points appended to the spool",
+    "spool_segments_total": "Spool segments sealed",
+    "spool_drained_total": "Spooled points written to the storage backend",
+    "spool_write_errors_total": "Failed attempts to write a spool segment",
+}
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    values = ",".join(f'{key}="{value}"'.replace("\n", " ") for key, value in labels)
+    return "{" + values + "}"
+
+class Histogram:
+    """
+    Counts of the observations below every bound of BUCKETS with their sum, like a Prometheus histogram
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile, None without observations
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+class Registry:
+    """
+    Counters, gauges and histograms of a process, each identified by a name and a set of labels.
+    Every method is thread safe, the fetcher workers and the pipeline stages share one registry.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, _labels(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # observes the duration of the block even when it raises
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def value(self, name, **labels):
+        """
+        Sum of a counter over the label sets matching labels
+        """
+        wanted = set(_labels(labels))
+        with self.lock:
+            return sum(value for (counter, counter_labels), value in self.counters.items()
+                       if counter == name and wanted <= set(counter_labels))
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            lines = []
+            described = set()
+            def describe(name, kind):
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+                    lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for (name, labels), value in counters:
+                describe(name, "counter")
+                lines.append(f"{PREFIX}{name}{_format(labels)} {value}")
+            for (name, labels), value in gauges:
+                describe(name, "gauge")
+                lines.append(f"{PREFIX}{name}{_format(labels)} {value}")
+            for (name, labels), histogram in histograms:
+                describe(name, "histogram")
+                total = 0
+                for bound, count in zip(histogram.buckets + [float("inf")], histogram.counts):
+                    total += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{PREFIX}{name}_bucket{_format(labels, [('le', le)])} {total}")
+                lines.append(f"{PREFIX}{name}_sum{_format(labels)} {histogram.sum}")
+                lines.append(f"{PREFIX}{name}_count{_format(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        """
+        Summary of the metrics as a dictionary: the counters and gauges, the count, total, mean
+        and approximate p50/p95 of every histogram, and the derived rates of the run
+        """
+        with self.lock:
+            elapsed = time.time() - self.started
+            report = {
+                "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+                "elapsed_seconds": elapsed,
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [{
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "total_seconds": histogram.sum,
+                    "mean_seconds": histogram.sum / histogram.count if histogram.count else None,
+                    "p50_seconds": histogram.quantile(0.5),
+                    "p95_seconds": histogram.quantile(0.95),
+                } for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])],
+            }
+        rates = {}
+        for name in ("points_transformed_total", "points_written_total", "requests_total"):
+            rates[name.replace("_total", "_per_second")] = self.value(name) / max(elapsed, 1e-9)
+        for cache in ("response", "query"):
+            hits = self.value("cache_lookups_total", cache=cache, result="hit")
+            lookups = self.value("cache_lookups_total", cache=cache)
+            rates[f"{cache}_cache_hit_rate"] = hits / lookups if lookups else None
+        report["rates"] = rates
+        return report
+
+# registry of the process, used by fetcher.py, influxBackup.py, storage.py, query.py and the caches
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+def writeReport(path=None, extra=None, registry=registry):
+    """
+    Write the JSON report of the run
+
+    Args:
+        path: file of the report, defaults to REPORT_DIR/run-<time>.json
+        extra: dictionary added to the report, e.g. the per stage results
+    Returns:
+        path: file the report was written to
+    """
+    report = registry.report()
+    report.update(extra or {})
+    if path is None:
+        path = os.path.join(REPORT_DIR, f"run-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+def serve(port=PORT, host="127.0.0.1", registry=registry):
+    """
+    Serve /metrics in the Prometheus text format and /report as JSON from a daemon thread
+
+    Returns:
+        server: the ThreadingHTTPServer, call shutdown() to stop it
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics"):
+                body = registry.prometheus().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path.startswith("/report"):
+                body = json.dumps(registry.report(), indent=2).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
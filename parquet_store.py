@@ -0,0 +1,213 @@
+import os
+import time
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import flux
+import influxBackup as influxBackup
+import query
+
+# root of the local copy of the bucket, one directory per measurement and month
+STORE_DIR = os.environ.get("garmin_store_dir", "garmin_store")
+# rows per row group, the time statistics of every row group let reads skip the ones out of range
+ROW_GROUP_SIZE = 64 * 1024
+COMPRESSION = "zstd"
+
+
+def _month(timestamp):
+    return timestamp.strftime("%Y-%m")
+
+class ParquetStore:
+    """
+    Local columnar copy of the bucket stored as
+    <path>/measurement=<measurement>/month=<yyyy-mm>/part-<id>.parquet
+
+    Every file holds the points of one measurement and one month sorted by time, with a time
+    column and one column per field. Appends add files, compact merges the files of a month.
+    """
+    def __init__(self, path=STORE_DIR, row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+    def _dir(self, measurement, month=None):
+        directory = os.path.join(self.path, f"measurement={measurement}")
+        return directory if month is None else os.path.join(directory, f"month={month}")
+
+    def measurements(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name.split("=", 1)[1] for name in os.listdir(self.path) if name.startswith("measurement="))
+
+    def months(self, measurement):
+        directory = self._dir(measurement)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name.split("=", 1)[1] for name in os.listdir(directory) if name.startswith("month="))
+
+    def files(self, measurement, start=None, stop=None):
+        """
+        Files of a measurement holding the months between start and stop, other months are not even listed
+        """
+        start, stop = flux.utcTimestamp(start), flux.utcTimestamp(stop)
+        files = []
+        for month in self.months(measurement):
+            if (start is not None and month < _month(start)) or (stop is not None and month > _month(stop)):
+                continue
+            directory = self._dir(measurement, month)
+            files += [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".parquet")]
+        return files
+
+    def _dataset(self, files):
+        # fields missing from some files are null there, integers are promoted to floats if another file has floats
+        schema = pa.unify_schemas([pq.read_schema(file) for file in files], promote_options="permissive")
+        return ds.dataset(files, schema=schema, format="parquet")
+
+    def fields(self, measurement):
+        files = self.files(measurement)
+        if not files:
+            return []
+        return [name for name in self._dataset(files).schema.names if name != "time"]
+
+    def append(self, measurement, df):
+        """
+        Add points to a measurement, one new file per month of the points
+
+        Args:
+            measurement: measurement name
+            df: DataFrame with one column per field and a DatetimeIndex, naive times are UTC
+        Returns:
+            count: number of rows written
+        """
+        if df.empty:
+            return 0
+        df = df.copy()
+        df.index = pd.DatetimeIndex(df.index, name="time")
+        if df.index.tz is None:
+            df.index = df.index.tz_localize("UTC")
+        else:
+            df.index = df.index.tz_convert("UTC")
+        df = df.sort_index()
+        for month, chunk in df.groupby(df.index.strftime("%Y-%m"), sort=False):
+            self._write(measurement, month, pa.Table.from_pandas(chunk.reset_index(), preserve_index=False))
+        return len(df)
+
+    def _write(self, measurement, month, table):
+        directory = self._dir(measurement, month)
+        os.makedirs(directory, exist_ok=True)
+        # the name sorts by creation time so that compact keeps the latest copy of a point
+        name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp = os.path.join(directory, f".{name}.tmp")
+        pq.write_table(table, tmp, row_group_size=self.row_group_size, compression=self.compression, write_statistics=True)
+        os.replace(tmp, os.path.join(directory, name))
+
+    def read(self, measurement, columns=None, start=None, stop=None):
+        """
+        Points of a measurement between start (included) and stop (excluded), only the months in range
+        are opened, only the row groups whose time statistics overlap the range are read and only
+        the requested columns are decoded
+
+        Args:
+            measurement: measurement name
+            columns: list of field names, None for all of them
+            start: datetime.date, datetime.datetime or None for the first point
+            stop: datetime.date, datetime.datetime or None for after the last point
+        Returns:
+            df: DataFrame with one column per field and a UTC DatetimeIndex named time
+        """
+        start, stop = flux.utcTimestamp(start), flux.utcTimestamp(stop)
+        files = self.files(measurement, start, stop)
+        if not files:
+            return pd.DataFrame(columns=columns or [], index=pd.DatetimeIndex([], tz="UTC", name="time"))
+        dataset = self._dataset(files)
+        columns = [column for column in (columns or dataset.schema.names) if column != "time" and column in dataset.schema.names]
+        condition = None
+        if start is not None:
+            condition = ds.field("time") >= pa.scalar(start, type=dataset.schema.field("time").type)
+        if stop is not None:
+            before_stop = ds.field("time") < pa.scalar(stop, type=dataset.schema.field("time").type)
+            condition = before_stop if condition is None else condition & before_stop
+        table = dataset.to_table(columns=["time"] + columns, filter=condition)
+        df = table.to_pandas().set_index("time")
+        return df.sort_index()
+
+    def lastTime(self, measurement):
+        """
+        Time of the latest point of a measurement read from the row group statistics of its last month,
+        None when the store has no point of the measurement
+        """
+        for month in reversed(self.months(measurement)):
+            last = None
+            for file in self.files(measurement, f"{month}-01", f"{month}-01"):
+                metadata = pq.ParquetFile(file).metadata
+                column = metadata.schema.names.index("time")
+                for i in range(metadata.num_row_groups):
+                    statistics = metadata.row_group(i).column(column).statistics
+                    if statistics is not None and statistics.has_min_max:
+                        value = pd.Timestamp(statistics.max)
+                        value = value.tz_localize("UTC") if value.tzinfo is None else value
+                        last = value if last is None else max(last, value)
+            if last is not None:
+                return last
+        return None
+
+    def compact(self, measurement):
+        """
+        Merge the files of every month of a measurement into a single file sorted by time,
+        keeping the latest copy of the points written more than once
+        """
+        for month in self.months(measurement):
+            files = self.files(measurement, f"{month}-01", f"{month}-01")
+            if len(files) <= 1:
+                continue
+            table = self._dataset(files).to_table()
+            df = table.to_pandas()
+            # files are listed oldest first so the last duplicate is the latest one
+            df = df.drop_duplicates(subset="time", keep="last").sort_values("time")
+            self._write(measurement, month, pa.Table.from_pandas(df, preserve_index=False))
+            for file in files:
+                os.remove(file)
+
+    def sync(self, client, measurements, start, stop, bucket=influxBackup.bucket, org=influxBackup.org):
+        """
+        Copy the points of InfluxDB that are newer than the latest point of the store, a month at a time
+
+        Args:
+            client: InfluxDB client
+            measurements: dictionary of measurement: list of field names like influxBackup.getListOfMeasurements returns
+            start: datetime.date used for the measurements not in the store yet
+            stop: datetime.date or datetime.datetime object
+        Returns:
+            count: number of rows appended
+        """
+        count = 0
+        stop = flux.utcTimestamp(stop)
+        for measurement, fields in measurements.items():
+            last = self.lastTime(measurement)
+            first = flux.utcTimestamp(start) if last is None else max(flux.utcTimestamp(start), last + pd.Timedelta(nanoseconds=1))
+            # one query per month keeps the memory used by a first sync bounded
+            for month_start in pd.date_range(first.normalize().replace(day=1), stop, freq="MS"):
+                month_start = max(month_start, first)
+                month_stop = min(month_start.normalize().replace(day=1) + pd.offsets.MonthBegin(1), stop)
+                if month_start >= month_stop:
+                    continue
+                df = query.queryFrame(client, [measurement], fields, month_start, month_stop, bucket, org)
+                # Flux ranges are to the second, the points already in the store are dropped here
+                if last is not None:
+                    df = df[df.index > last]
+                count += self.append(measurement, df)
+            print(f"{measurement}: store holds points up to {self.lastTime(measurement)}")
+        return count
+
+    def populate_df(self, selected_measurements, selected_fields, start, stop):
+        """
+        Same result as query.populate_df but read from the store instead of InfluxDB
+        """
+        dfs = []
+        for measurement in selected_measurements:
+            fields = [field for field in selected_fields if field in self.fields(measurement)]
+            if fields:
+                dfs += query.splitFields(self.read(measurement, fields, start, stop))
+        return dfs
@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+import fetcher
+import influxBackup as influxBackup
+import metrics
+
+
+class Stage:
+    """
+    One source of the backup: collect(limiter) returns the data points (or per-day
+    lists of data points) of the source and they are written with influxBackup.backupData
+    """
+    def __init__(self, name, collect):
+        self.name = name
+        self.collect = collect
+        self.requests = 0
+        self.points = 0
+        self.seconds = 0.0
+        self.error = None
+
+def _run_stage(stage, influxdb_client, limiter, write):
+    counting_limiter = fetcher.CountingLimiter(limiter)
+    start_time = time.perf_counter()
+    try:
+        stage.points = write(influxdb_client, stage.collect(counting_limiter))
+    except Exception as err:
+        stage.error = err
+        print(f"Stage {stage.name} failed: {err}")
+    stage.seconds = time.perf_counter() - start_time
+    stage.requests = counting_limiter.requests
+    metrics.registry.set("stage_points", stage.points, stage=stage.name)
+    metrics.registry.set("stage_seconds", stage.seconds, stage=stage.name)
+    metrics.registry.set("stage_requests", stage.requests, stage=stage.name)
+    return stage
+
+def run_stages(stages, influxdb_client, limiter=None, max_parallel=None, write=influxBackup.backupData):
+    """
+    Run the stages concurrently, every stage streams its data from Garmin Connect to InfluxDB
+    so fetching and writing overlap, and all the stages share the same request budget
+
+    Args:
+        stages: list of Stage
+        influxdb_client: InfluxDB client, or storage backend, passed to write
+        limiter: fetcher.RateLimiter shared by all the stages, defaults to fetcher.default_limiter
+        max_parallel: number of stages running at the same time, defaults to all of them
+        write: function writing the data of a stage and returning the number of points written
+    Returns:
+        stages: the stages with their requests, points, seconds and error filled in
+    """
+    limiter = limiter or fetcher.default_limiter
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_parallel or max(1, len(stages))) as executor:
+        list(executor.map(lambda stage: _run_stage(stage, influxdb_client, limiter, write), stages))
+    printTimings(stages, time.perf_counter() - start_time)
+    return stages
+
+def printTimings(stages, elapsed):
+    print(f"{'stage':<16}{'requests':>10}{'points':>12}{'seconds':>10}{'points/sec':>12}")
+    for stage in stages:
+        rate = stage.points / stage.seconds if stage.seconds else 0
+        line = f"{stage.name:<16}{stage.requests:>10}{stage.points:>12}{stage.seconds:>10.1f}{rate:>12.0f}"
+        if stage.error is not None:
+            line += "  FAILED"
+        print(line)
+    requests = sum(stage.requests for stage in stages)
+    points = sum(stage.points for stage in stages)
+    print(f"{'total':<16}{requests:>10}{points:>12}{elapsed:>10.1f}{points / max(elapsed, 1e-9):>12.0f}")
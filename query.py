@@ -0,0 +1,269 @@
+import time
+from influxdb_client.domain.dialect import Dialect
+import numpy as np
+import pandas as pd
+import flux
+import influxBackup as influxBackup
+import metrics
+import rollups
+
+# plain CSV with a header row and no annotations, parsed by pandas' C parser
+CSV_DIALECT = Dialect(header=True, annotations=[], date_time_format="RFC3339")
+# columns added by InfluxDB to every CSV result
+RESULT_COLUMNS = ["", "result", "table"]
+# maximum number of points per field sent to the browser
+POINT_BUDGET = 2000
+# aggregation windows tried from the finest to the coarsest, in seconds with their Flux duration
+WINDOWS = [(60, "1m"), (5 * 60, "5m"), (15 * 60, "15m"), (30 * 60, "30m"), (60 * 60, "1h"), (3 * 60 * 60, "3h"),
+           (6 * 60 * 60, "6h"), (12 * 60 * 60, "12h"), (24 * 60 * 60, "1d"), (7 * 24 * 60 * 60, "7d")]
+# the epoch is a Thursday, weekly windows are shifted to start on Monday like the weekly rollups
+WEEK_OFFSET = 4 * 24 * 60 * 60
+# with LTTB the query returns this many times the point budget and LTTB picks the points to keep
+LTTB_OVERSAMPLING = 4
+
+
+def _seconds(start, stop):
+    return (pd.Timestamp(stop) - pd.Timestamp(start)).total_seconds()
+
+def pickWindow(start, stop, points=POINT_BUDGET):
+    """
+    Smallest aggregation window giving at most points points per field between start and stop
+
+    Args:
+        start: datetime.date or datetime.datetime object
+        stop: datetime.date or datetime.datetime object
+        points: point budget per field
+    Returns:
+        window: Flux duration such as "15m", None when the raw points fit in the budget
+    """
+    seconds = _seconds(start, stop) / points
+    if seconds <= WINDOWS[0][0]:
+        return None
+    for window_seconds, window in WINDOWS:
+        if window_seconds >= seconds:
+            return window
+    return f"{-(-int(seconds) // (24 * 60 * 60))}d"
+
+def windowSeconds(window):
+    return int(window[:-1]) * {"m": 60, "h": 60 * 60, "d": 24 * 60 * 60}[window[-1]]
+
+def queryWindow(start, stop, points=POINT_BUDGET, lttb_pass=False):
+    """
+    Aggregation window used by populate_df for a point budget, LTTB needs more points to pick from
+    """
+    return pickWindow(start, stop, points * LTTB_OVERSAMPLING if lttb_pass else points)
+
+def describeResolution(window, lttb=False, rollup=None):
+    resolution = "raw points" if window is None else f"mean over {window}"
+    if rollup is not None:
+        resolution += f" of the {rollup} heart rate rollups"
+    return f"{resolution} + LTTB" if lttb else resolution
+
+def windowOffset(window):
+    # seconds between the epoch and the start of the first window, every backend aligns the windows to the epoch
+    return WEEK_OFFSET if window == "7d" else 0
+
+def _every(window):
+    return f"every: {window}, offset: {windowOffset(window)}s"
+
+def buildQuery(measurements, fields, start, stop, bucket=influxBackup.bucket, window=None):
+    """
+    Flux query returning one column per field, the pivot and the column pruning are done by InfluxDB
+
+    Args:
+        measurements: list of measurement names
+        fields: list of field names
+        start: datetime.date or datetime.datetime object
+        stop: datetime.date or datetime.datetime object
+        window: Flux duration of the mean computed by InfluxDB, None for the raw points
+    Returns:
+        query: Flux query
+    """
+    # the mean only applies to numbers, other fields are left out of aggregated queries
+    aggregate = ""
+    if window is not None:
+        aggregate = f'|> filter(fn: (r) => types.isNumeric(v: r._value))\
+        |> aggregateWindow({_every(window)}, fn: mean, createEmpty: false, timeSrc: "_start")'
+    selection = f'from(bucket: "{bucket}")\
+        |> range(start: {flux.fluxTime(start)}, stop: {flux.fluxTime(stop)})\
+        |> filter(fn: (r) => ({flux.anyOf("_measurement", measurements)}) and ({flux.anyOf("_field", fields)}))'
+    # long ranges of intraday heart rate are averaged from the means of its rollups instead of the raw samples,
+    # every rollup weighs as much as the samples it summarizes
+    rollup = rollups.rollupWindow(measurements, fields, window)
+    if rollup is not None:
+        selection = f'union(tables: [\
+            {selection}\
+                |> filter(fn: (r) => not (r._measurement == "{rollups.MEASUREMENT}" and r._field == "{rollups.FIELD}"))\
+                {aggregate}\
+                |> keep(columns: ["_time", "_field", "_value"]),\
+            from(bucket: "{bucket}")\
+                |> range(start: {flux.fluxTime(start)}, stop: {flux.fluxTime(stop)})\
+                |> filter(fn: (r) => r._measurement == "{rollups.ROLLUP_MEASUREMENT}" and r.window == "{rollup}" and (r._field == "mean" or r._field == "count"))\
+                |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")\
+                |> map(fn: (r) => ({{r with total: r.mean * float(v: r.count), count: float(v: r.count)}}))\
+                |> window({_every(window)}, createEmpty: false)\
+                |> reduce(identity: {{total: 0.0, count: 0.0}}, fn: (r, accumulator) => ({{total: accumulator.total + r.total, count: accumulator.count + r.count}}))\
+                |> map(fn: (r) => ({{r with _time: r._start, _field: "{rollups.FIELD}", _value: r.total / r.count}}))\
+                |> keep(columns: ["_time", "_field", "_value"])])'
+        aggregate = ""
+    # each table holds one field so the pivot gives tables of _time and that field,
+    # group() then puts them in a single table so that the CSV has a single header
+    return f'import "types"\n\
+        {selection}\
+        {aggregate}\
+        |> keep(columns: ["_time", "_field", "_value"])\
+        |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")\
+        |> group()'
+
+def readCsv(csv):
+    """
+    Read the CSV result of a query built with buildQuery into a DataFrame indexed by time
+
+    Args:
+        csv: file-like object or path holding the CSV result
+    Returns:
+        df: DataFrame with one column per field and a UTC DatetimeIndex named time
+    """
+    try:
+        df = pd.read_csv(csv, usecols=lambda column: column not in RESULT_COLUMNS and not column.startswith("Unnamed"))
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(index=pd.DatetimeIndex([], tz="UTC", name="time"))
+    df["_time"] = flux.parseTimes(df["_time"])
+    df = df.rename(columns={"_time": "time"})
+    # fields of the same time are on separate rows, one per table before group()
+    if df["time"].duplicated().any():
+        df = df.groupby("time").first()
+    else:
+        df = df.set_index("time")
+    return df.sort_index()
+
+def queryFrame(client, measurements, fields, start, stop, bucket=influxBackup.bucket, org=influxBackup.org, window=None):
+    """
+    Get the selected fields between start and stop as a single wide DataFrame
+
+    Args:
+        client: InfluxDB client
+        measurements: list of measurement names
+        fields: list of field names
+        start: datetime.date or datetime.datetime object
+        stop: datetime.date or datetime.datetime object
+        window: Flux duration of the mean computed by InfluxDB, None for the raw points
+    Returns:
+        df: DataFrame with one column per field and a UTC DatetimeIndex named time
+    """
+    query = buildQuery(measurements, fields, start, stop, bucket, window)
+    start_time = time.perf_counter()
+    response = client.query_api().query_raw(query, org=org, dialect=CSV_DIALECT)
+    try:
+        df = readCsv(response)
+    finally:
+        response.close()
+    # the time until the result is parsed, InfluxDB streams the rows while readCsv reads them
+    metrics.observe("query_seconds", time.perf_counter() - start_time, backend="influx")
+    metrics.inc("query_rows_total", len(df), backend="influx")
+    return df
+
+def splitFields(df):
+    """
+    Split a wide DataFrame into one DataFrame per field without the times where the field has no value
+    """
+    return [df[[field]].dropna() for field in df.columns]
+
+def lttb(df, points):
+    """
+    Largest-Triangle-Three-Buckets downsampling of a DataFrame holding a single field,
+    keeps the first and last points and in every bucket the point making the largest
+    triangle with the previous kept point and the mean of the next bucket
+
+    Args:
+        df: DataFrame with a single numeric column indexed by time
+        points: number of points to keep
+    Returns:
+        df: DataFrame with at most points rows
+    """
+    n = len(df)
+    if n <= points or points < 3 or not pd.api.types.is_numeric_dtype(df.dtypes.iloc[0]):
+        return df
+    x = df.index.asi8.astype(float)
+    y = df.iloc[:, 0].to_numpy(dtype=float)
+    # points - 2 buckets between the first and the last point
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(points - 2):
+        low, high = edges[i], edges[i + 1]
+        next_high = edges[i + 2] if i + 2 < len(edges) else n
+        mean_x = x[high:next_high].mean()
+        mean_y = y[high:next_high].mean()
+        area = np.abs((x[a] - mean_x) * (y[low:high] - y[a]) - (x[a] - x[low:high]) * (mean_y - y[a]))
+        a = low + int(area.argmax())
+        selected[i + 1] = a
+    return df.iloc[selected]
+
+def mergeDetail(overview, detail, start, stop):
+    """
+    Replace the rows of overview between start and stop by the rows of detail
+
+    Args:
+        overview: DataFrame with a single field indexed by time
+        detail: DataFrame of the same field between start and stop, None when the field has no points there
+        start: UTC pandas Timestamp
+        stop: UTC pandas Timestamp
+    Returns:
+        df: DataFrame with the detail inside the range and the overview outside of it
+    """
+    if detail is None:
+        return overview
+    outside = overview[(overview.index < start) | (overview.index >= stop)]
+    return pd.concat([outside, detail]).sort_index()
+
+def populate_df(client, selected_measurements, selected_fields, start, stop, bucket=influxBackup.bucket, org=influxBackup.org, points=None, lttb_pass=False, cache=None):
+    """
+    Get the selected fields between start and stop
+
+    Args:
+        client: InfluxDB client
+        selected_measurements: list of measurement names
+        selected_fields: list of field names
+        start: datetime.date or datetime.datetime object
+        stop: datetime.date or datetime.datetime object
+        points: point budget per field, InfluxDB averages the points over a window picked by pickWindow,
+            None for all the raw points
+        lttb_pass: fetch LTTB_OVERSAMPLING times the budget and keep the points that best preserve the shape of the line
+        cache: optional query_cache.QueryCache holding the results of previous calls
+    Returns:
+        dfs: list of DataFrames, one per field, indexed by time
+    """
+    resolution = (bucket, points, lttb_pass)
+    return cached(cache, selected_measurements, selected_fields, start, stop, resolution,
+                  lambda: _populate_df(client, selected_measurements, selected_fields, start, stop, bucket, org, points, lttb_pass))
+
+def cached(cache, measurements, fields, start, stop, resolution, compute):
+    """
+    Result of compute() for a selection, taken from the query_cache.QueryCache cache when it holds it
+
+    Args:
+        cache: query_cache.QueryCache or None to always call compute
+        resolution: anything hashable telling apart the results of the same selection
+        compute: function returning the list of DataFrames of the selection
+    """
+    if cache is None:
+        return compute()
+    key = cache.key(measurements, fields, start, stop, resolution)
+    dfs = cache.get(key)
+    if dfs is None:
+        sent = time.time()
+        dfs = compute()
+        cache.put(key, dfs, sent)
+    return dfs
+
+def _populate_df(client, selected_measurements, selected_fields, start, stop, bucket, org, points, lttb_pass):
+    if points is None:
+        return splitFields(queryFrame(client, selected_measurements, selected_fields, start, stop, bucket, org))
+    window = queryWindow(start, stop, points, lttb_pass)
+    dfs = splitFields(queryFrame(client, selected_measurements, selected_fields, start, stop, bucket, org, window))
+    if lttb_pass:
+        dfs = [lttb(df, points) for df in dfs]
+    return dfs
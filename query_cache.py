@@ -0,0 +1,174 @@
+from collections import OrderedDict
+import datetime
+import hashlib
+import os
+import threading
+import time
+import pandas as pd
+import flux
+import metrics
+import response_cache
+
+# where the query results shared between processes are stored
+CACHE_DIR = os.path.join(response_cache.CACHE_DIR, "queries")
+# one file per measurement, touched by influxBackup.backupData every time it writes to the measurement
+WRITES_DIR = os.path.join(response_cache.CACHE_DIR, "writes")
+# memory above which the least recently used results are dropped (bytes)
+MAX_BYTES = 256 * 1024 * 1024
+
+
+def markWritten(measurements, path=None):
+    """
+    Record that data was written to the measurements, the cached results of recent ranges
+    of these measurements are not used anymore, in this process or in any other one
+
+    Args:
+        path: directory of the markers, WRITES_DIR by default
+    """
+    if not measurements:
+        return
+    path = path or WRITES_DIR
+    os.makedirs(path, exist_ok=True)
+    for measurement in measurements:
+        file = os.path.join(path, measurement)
+        with open(file, "a"):
+            pass
+        os.utime(file)
+
+def lastWrite(measurement, path=None):
+    try:
+        return os.path.getmtime(os.path.join(path or WRITES_DIR, measurement))
+    except OSError:
+        return 0.0
+
+class QueryCache:
+    """
+    Least recently used cache of query.populate_df results keyed on the normalized
+    (measurements, fields, start, stop, resolution), optionally shared on disk
+
+    Results of ranges ending more than settle_days ago never change and are kept until evicted,
+    results of recent ranges are dropped once influxBackup.backupData writes to one of their measurements
+    """
+    def __init__(self, max_bytes=MAX_BYTES, path=None, settle_days=response_cache.SETTLE_DAYS, writes=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.settle_days = settle_days
+        self.writes = writes
+        # key -> (dfs, bytes, created, recent)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def key(self, measurements, fields, start, stop, resolution=None):
+        """
+        Args:
+            measurements: list of measurement names
+            fields: list of field names
+            start: datetime.date, datetime.datetime or pandas Timestamp
+            stop: datetime.date, datetime.datetime or pandas Timestamp
+            resolution: anything hashable telling apart results of the same range, e.g. (points, lttb)
+        """
+        return (tuple(sorted(set(measurements))), tuple(sorted(set(fields))),
+                flux.utcTimestamp(start).isoformat(), flux.utcTimestamp(stop).isoformat(), resolution)
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{hashlib.sha1(repr(key).encode()).hexdigest()}.pkl")
+
+    def _remove(self, key):
+        if self.path is None:
+            return
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def _recent(self, key):
+        settled = pd.Timestamp.now(tz="UTC").normalize() - datetime.timedelta(days=self.settle_days)
+        return pd.Timestamp(key[3]) > settled
+
+    def _valid(self, key, created):
+        return all(lastWrite(measurement, self.writes) < created for measurement in key[0])
+
+    def _add(self, key, dfs, created, recent):
+        size = int(sum(df.memory_usage(deep=True).sum() for df in dfs))
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        self.entries[key] = (dfs, size, created, recent)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_size, _, _) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Returns:
+            dfs: the cached list of DataFrames, None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                dfs, _, created, recent = entry
+                if not recent or self._valid(key, created):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    metrics.inc("cache_lookups_total", cache="query", result="hit")
+                    return dfs
+                self.bytes -= self.entries.pop(key)[1]
+                self.invalidations += 1
+                self._remove(key)
+            elif self.path is not None:
+                file = self._file(key)
+                try:
+                    created = os.path.getmtime(file)
+                    recent = self._recent(key)
+                    if not recent or self._valid(key, created):
+                        dfs = pd.read_pickle(file)
+                        self._add(key, dfs, created, recent)
+                        self.hits += 1
+                        metrics.inc("cache_lookups_total", cache="query", result="hit")
+                        return dfs
+                    self._remove(key)
+                    self.invalidations += 1
+                except (OSError, ValueError, EOFError):
+                    pass
+            self.misses += 1
+            metrics.inc("cache_lookups_total", cache="query", result="miss")
+            return None
+
+    def put(self, key, dfs, created=None):
+        """
+        Args:
+            key: key returned by QueryCache.key
+            dfs: list of DataFrames returned by the query
+            created: time.time() at which the query was sent, so that a write happening
+                while the query runs invalidates the result
+        """
+        created = created or time.time()
+        recent = self._recent(key)
+        with self.lock:
+            self._add(key, dfs, created, recent)
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+            file = self._file(key)
+            tmp = f"{file}.{threading.get_ident()}.tmp"
+            pd.to_pickle(dfs, tmp)
+            os.utime(tmp, (created, created))
+            os.replace(tmp, file)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
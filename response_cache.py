@@ -0,0 +1,145 @@
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+import metrics
+
+# where the raw Garmin responses are stored
+CACHE_DIR = os.environ.get("garmin_cache_dir", ".garmin_cache")
+# days older than this never change on Garmin's side, their responses fetched since are served from disk forever
+SETTLE_DAYS = 7
+# how long a response for a recent day stays valid (seconds)
+TTL = 6 * 60 * 60
+# size above which the least recently used responses are evicted (bytes)
+MAX_BYTES = 512 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    Local cache of the raw JSON responses returned by Garmin Connect, keyed by
+    endpoint and calendar date and stored gzip compressed under
+    <path>/<endpoint>/<yyyy-mm-dd>.json.gz
+    """
+    def __init__(self, path=None, settle_days=SETTLE_DAYS, ttl=TTL, max_bytes=MAX_BYTES):
+        self.path = path or CACHE_DIR
+        self.settle_days = settle_days
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _file(self, endpoint, date):
+        return os.path.join(self.path, endpoint, f"{date.isoformat()}.json.gz")
+
+    def is_settled(self, date, fetched=None):
+        """
+        True if a response for date fetched at the timestamp fetched, now by default, can no longer change
+        """
+        fetched = datetime.date.fromtimestamp(time.time() if fetched is None else fetched)
+        return fetched >= date + datetime.timedelta(days=self.settle_days)
+
+    def get(self, endpoint, date):
+        """
+        Args:
+            endpoint: name of the Garmin endpoint, e.g. "heart_rates"
+            date: datetime.date object
+        Returns:
+            hit: True if a fresh response was found
+            response: the cached response (None on a miss)
+        """
+        file = self._file(endpoint, date)
+        try:
+            # the modification time is when the response was fetched, a response fetched before its
+            # day settled may be partial and expires like the responses of recent days
+            fetched = os.path.getmtime(file)
+            age = time.time() - fetched
+            if not self.is_settled(date, fetched) and age > self.ttl:
+                with self.lock:
+                    self.stale += 1
+                    self.misses += 1
+                metrics.inc("cache_lookups_total", cache="response", result="stale")
+                return False, None
+            with gzip.open(file, "rt", encoding="utf-8") as f:
+                response = json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            metrics.inc("cache_lookups_total", cache="response", result="miss")
+            return False, None
+        try:
+            # touch the file so that eviction drops the least recently used responses first
+            os.utime(file, (time.time(), fetched))
+        except OSError:
+            # evicted by another stage since it was read
+            pass
+        with self.lock:
+            self.hits += 1
+        metrics.inc("cache_lookups_total", cache="response", result="hit")
+        return True, response
+
+    def put(self, endpoint, date, response):
+        file = self._file(endpoint, date)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp = f"{file}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(response, f)
+        os.replace(tmp, file)
+
+    def _entries(self):
+        # (access time, size, file) of the responses only: the query cache, the write markers, the
+        # catalogs and the run reports live under the same directory, and so do the responses being put
+        entries = []
+        try:
+            endpoints = [os.path.join(self.path, name) for name in os.listdir(self.path)]
+        except OSError:
+            return entries
+        for endpoint in endpoints:
+            if not os.path.isdir(endpoint):
+                continue
+            for name in os.listdir(endpoint):
+                if not name.endswith(".json.gz"):
+                    continue
+                file = os.path.join(endpoint, name)
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, file))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Remove the least recently used responses until the cache is below max_bytes
+        """
+        # the collectors of the stages running at the same time evict when they finish
+        with self.lock:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, file in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(file)
+                except OSError:
+                    # evicted by another process
+                    pass
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,219 @@
+import argparse
+import datetime
+import json
+import os
+import threading
+import pandas as pd
+import catalog
+import influxBackup as influxBackup
+import query
+import query_cache
+
+# intraday measurement summarized by the rollups
+MEASUREMENT = "RealTimeHeartRate"
+FIELD = "heartRateValue"
+# measurement holding the rollups, the window tag tells the hourly, daily and weekly ones apart
+ROLLUP_MEASUREMENT = "RealTimeHeartRateRollup"
+# rollup windows as Flux durations with their length in seconds, weeks start on Monday
+WINDOWS = [("1h", 60 * 60), ("1d", 24 * 60 * 60), ("7d", 7 * 24 * 60 * 60)]
+PERCENTILES = [5, 25, 50, 75, 95]
+# weeks rolled up per query, only their samples are held in memory
+CHUNK_WEEKS = 4
+# day numbers count the days since EPOCH like influxBackup.batches
+EPOCH = datetime.date(1970, 1, 1)
+# days written since their rollups were last computed, kept next to the catalog until they are rolled up
+PENDING_FILE = "rollups-pending.json"
+
+_pending_lock = threading.Lock()
+
+
+def weekStart(date):
+    return date - datetime.timedelta(days=date.weekday())
+
+def _windowStarts(index, window):
+    if window == "1h":
+        return index.floor("h")
+    days = index.floor("D")
+    if window == "1d":
+        return days
+    return days - pd.to_timedelta(index.dayofweek, unit="D")
+
+def compute(df, window):
+    """
+    Statistics of the heart rate samples of every window
+
+    Args:
+        df: DataFrame with a heartRateValue column indexed by time, like query.queryFrame returns
+        window: one of the Flux durations of WINDOWS
+    Returns:
+        stats: DataFrame indexed by the start of the windows with min, max, mean, count and the p<n> percentiles
+    """
+    values = df[FIELD].dropna()
+    groups = values.groupby(_windowStarts(values.index, window))
+    stats = groups.agg(["min", "max", "mean", "count"])
+    percentiles = groups.quantile([percentile / 100 for percentile in PERCENTILES]).unstack()
+    percentiles.columns = [f"p{percentile}" for percentile in PERCENTILES]
+    return stats.join(percentiles)
+
+def toLineProtocol(stats, window):
+    """
+    Line protocol of the rollups of a window, the times are the starts of the windows
+    """
+    times = stats.index.asi8.tolist()
+    columns = {column: stats[column].tolist() for column in stats.columns}
+    lines = []
+    for i, t in enumerate(times):
+        fields = [f"min={int(columns['min'][i])}i", f"max={int(columns['max'][i])}i", f"mean={float(columns['mean'][i])}",
+                  f"count={int(columns['count'][i])}i"]
+        fields += [f"p{percentile}={float(columns[f'p{percentile}'][i])}" for percentile in PERCENTILES]
+        lines.append(f"{ROLLUP_MEASUREMENT},window={window} {','.join(fields)} {t}")
+    return lines
+
+def _updateChunk(client, start, stop, bucket, org, write):
+    df = query.queryFrame(client, [MEASUREMENT], [FIELD], start, stop, bucket, org)
+    if FIELD not in df.columns or df[FIELD].isna().all():
+        return 0
+    df.index = df.index.tz_localize(None)
+    lines = [line for window, _ in WINDOWS for line in toLineProtocol(compute(df, window), window)]
+    return write(client, lines)
+
+def update(client, start_date, stop_date, bucket=influxBackup.bucket, org=influxBackup.org, write=influxBackup.backupData):
+    """
+    Recompute the rollups of the weeks holding the days between start_date and stop_date from the raw
+    samples in InfluxDB, CHUNK_WEEKS at a time. Rollups are overwritten in place so only the days
+    touched by a run need this
+
+    Args:
+        client: InfluxDB client
+        start_date: datetime.date object
+        stop_date: datetime.date object
+        write: function writing line protocol and returning the number of points written
+    Returns:
+        count: number of rollup points written
+    """
+    start = weekStart(start_date)
+    stop = weekStart(stop_date) + datetime.timedelta(days=7)
+    count = 0
+    while start < stop:
+        chunk_stop = min(start + datetime.timedelta(weeks=CHUNK_WEEKS), stop)
+        count += _updateChunk(client, start, chunk_stop, bucket, org, write)
+        start = chunk_stop
+    if count == 0:
+        print("No heart rate samples to roll up")
+        return 0
+    # queries routed to the rollups are cached under the raw measurement
+    query_cache.markWritten([MEASUREMENT])
+    return count
+
+def backfill(client, bucket=influxBackup.bucket, org=influxBackup.org, write=influxBackup.backupData):
+    """
+    Roll up the weeks between the oldest heart rate sample and the oldest rollup, e.g. the history
+    backed up before the rollups existed. Does nothing once the rollups reach back to the oldest
+    sample, which the dashboard relies on for the long ranges
+
+    Returns:
+        count: number of rollup points written
+    """
+    first_timestamps = influxBackup.getFirstTimestamps(client, [MEASUREMENT, ROLLUP_MEASUREMENT], bucket, org)
+    if MEASUREMENT not in first_timestamps:
+        return 0
+    start = weekStart(first_timestamps[MEASUREMENT].date())
+    if ROLLUP_MEASUREMENT in first_timestamps:
+        stop = weekStart(first_timestamps[ROLLUP_MEASUREMENT].date())
+    else:
+        stop = weekStart(datetime.date.today()) + datetime.timedelta(days=7)
+    if start >= stop:
+        return 0
+    print(f"Rolling up the heart rate samples from {start} to {stop}")
+    return update(client, start, stop - datetime.timedelta(days=1), bucket, org, write)
+
+def _pendingPath():
+    return os.path.join(catalog.CATALOG_DIR, PENDING_FILE)
+
+def _readPending():
+    try:
+        with open(_pendingPath(), encoding="utf-8") as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+def _writePending(days):
+    path = _pendingPath()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(sorted(days), f)
+    os.replace(tmp, path)
+
+def addPending(days):
+    """
+    Record the heart rate days of a successful write until updatePending rolls them up, so that
+    the days written by the drain of a previous run's spool or by a run that stopped early are
+    rolled up too. Set as the on_write function of the storage backend
+
+    Args:
+        days: dictionary of measurement: iterable of day numbers since 1970-01-01
+    """
+    numbers = days.get(MEASUREMENT)
+    if not numbers:
+        return
+    with _pending_lock:
+        pending = _readPending()
+        pending.update(int(number) for number in numbers)
+        _writePending(pending)
+
+def updatePending(client, bucket=influxBackup.bucket, org=influxBackup.org, write=influxBackup.backupData):
+    """
+    Roll up the weeks holding the days recorded by addPending, consecutive weeks CHUNK_WEEKS at a time,
+    and forget the days once their rollups are written
+
+    Returns:
+        count: number of rollup points written
+    """
+    with _pending_lock:
+        pending = _readPending()
+    if not pending:
+        return 0
+    weeks = sorted({weekStart(EPOCH + datetime.timedelta(days=number)) for number in pending})
+    # consecutive weeks merged into (first, last) tuples
+    ranges = []
+    for week in weeks:
+        if ranges and ranges[-1][1] + datetime.timedelta(days=7) == week:
+            ranges[-1] = (ranges[-1][0], week)
+        else:
+            ranges.append((week, week))
+    print(f"Rolling up the heart rate samples of {len(pending)} days")
+    count = 0
+    for first, last in ranges:
+        count += update(client, first, last, bucket, org, write)
+    # days written meanwhile are kept for the next update
+    with _pending_lock:
+        _writePending(_readPending() - pending)
+    return count
+
+def rollupWindow(measurements, fields, window):
+    """
+    Rollup window a query of measurements and fields aggregated over window can be answered from
+
+    Returns:
+        window: the coarsest rollup window whose windows tile window, None when the query needs the raw samples
+    """
+    if window is None or MEASUREMENT not in measurements or FIELD not in fields:
+        return None
+    seconds = query.windowSeconds(window)
+    rollups = [rollup for rollup, rollup_seconds in WINDOWS if seconds % rollup_seconds == 0]
+    return rollups[-1] if rollups else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the heart rate rollups from the samples in InfluxDB")
+    parser.add_argument("--days", type=int, default=None, help="number of days rolled up again, by default only the days written since their last rollup and the weeks older than the oldest rollup are rolled up")
+    args = parser.parse_args()
+    stop_date = datetime.date.today()
+    influxdb_client = influxBackup.getInfuxClient()
+    if args.days is None:
+        updatePending(influxdb_client)
+        backfill(influxdb_client)
+    else:
+        update(influxdb_client, stop_date - datetime.timedelta(days=args.days), stop_date)
+    influxdb_client.close()
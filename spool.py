@@ -0,0 +1,251 @@
+import argparse
+import gzip
+import os
+import re
+import threading
+import time
+import zlib
+import influxBackup as influxBackup
+import metrics
+import storage
+
+# where the fetched points wait until the storage backend has acknowledged them
+SPOOL_DIR = os.environ.get("garmin_spool_dir", "garmin_spool")
+# points per segment, a segment is written to the storage backend and deleted as a whole
+SEGMENT_POINTS = 100_000
+# attempts to write a segment before the drainer leaves it for the next run
+DRAIN_RETRIES = 3
+# seconds waited before the first retry, doubled after every failure
+RETRY_WAIT = 5
+SEGMENT = re.compile(r"segment-(\d+)-(\d+)\.lp\.gz$")
+
+
+class Spool:
+    """
+    Write-ahead log of the points fetched from Garmin Connect: every stage appends its points as
+    gzip compressed line protocol to segment files
+    <path>/segment-<sequence>-<points>.lp.gz
+    which are only deleted once the storage backend has written them. A run that fails to
+    write keeps its segments and the next run replays them without asking Garmin again.
+
+    A segment being written is named .segment-<sequence>.lp.gz.tmp and flushed to disk after every
+    chunk of data, i.e. every day of the garmin.py collectors, recover seals what a crashed run left of it.
+    """
+    def __init__(self, path=SPOOL_DIR, segment_points=SEGMENT_POINTS):
+        self.path = path
+        self.segment_points = segment_points
+        self.lock = threading.Lock()
+        self.sealed = threading.Condition(self.lock)
+        os.makedirs(path, exist_ok=True)
+        numbers = [int(name.split("-")[1].split(".")[0]) for name in os.listdir(path) if name.startswith(("segment-", ".segment-"))]
+        self.sequence = max(numbers, default=0)
+
+    def _next(self):
+        with self.lock:
+            self.sequence += 1
+            return self.sequence
+
+    def segments(self):
+        """
+        Sealed segments oldest first as (sequence, points, file) tuples
+        """
+        segments = []
+        for name in os.listdir(self.path):
+            match = SEGMENT.match(name)
+            if match:
+                segments.append((int(match.group(1)), int(match.group(2)), os.path.join(self.path, name)))
+        return sorted(segments)
+
+    def pending(self):
+        """
+        Number of points waiting to be written
+        """
+        return sum(points for _, points, _ in self.segments())
+
+    def _seal(self, sequence, tmp, points):
+        if points == 0:
+            os.remove(tmp)
+            return
+        # the segment is complete on disk before it becomes visible to the drainer
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, f"segment-{sequence:012d}-{points}.lp.gz"))
+        metrics.inc("spool_segments_total")
+        with self.sealed:
+            self.sealed.notify_all()
+
+    def append(self, data, batch_size=influxBackup.BATCH_SIZE, dedup=None):
+        """
+        Spool the data of a stage, same arguments as influxBackup.backupData
+
+        Returns:
+            count: number of points spooled
+        """
+        if data is None:
+            return 0
+        count = 0
+        segment = None
+        try:
+            for chunk in data:
+                if segment is None:
+                    sequence = self._next()
+                    tmp = os.path.join(self.path, f".segment-{sequence:012d}.lp.gz.tmp")
+                    segment = gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6)
+                    points = 0
+                for batch in influxBackup.batches([chunk], batch_size, dedup):
+                    segment.write("\n".join(batch) + "\n")
+                    points += len(batch)
+                    count += len(batch)
+                    metrics.inc("spool_points_total", len(batch))
+                # everything written so far can be read back if the process dies or the machine loses
+                # power, the collectors record a day in the journal only once its data is on disk
+                segment.flush()
+                os.fsync(segment.fileno())
+                if points >= self.segment_points:
+                    segment.close()
+                    self._seal(sequence, tmp, points)
+                    segment = None
+        finally:
+            # the days spooled before a failed request are kept
+            if segment is not None:
+                segment.close()
+                self._seal(sequence, tmp, points)
+        return count
+
+    def recover(self):
+        """
+        Seal the segments left open by a run that died while spooling, keeping their complete lines
+
+        Returns:
+            count: number of points recovered
+        """
+        count = 0
+        for name in sorted(os.listdir(self.path)):
+            if not (name.startswith(".segment-") and name.endswith(".tmp")):
+                continue
+            tmp = os.path.join(self.path, name)
+            lines = []
+            try:
+                with gzip.open(tmp, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        lines.append(line)
+            except (EOFError, OSError, zlib.error):
+                # the data after the last flush is lost, the day it belongs to is fetched again
+                pass
+            lines = [line for line in lines if line.endswith("\n")]
+            sequence = int(name.split("-")[1].split(".")[0])
+            if lines:
+                with gzip.open(tmp + ".recovered", "wt", encoding="utf-8") as f:
+                    f.writelines(lines)
+                os.replace(tmp + ".recovered", tmp)
+            self._seal(sequence, tmp, len(lines))
+            count += len(lines)
+        if count:
+            print(f"Recovered {count} spooled points of an interrupted run")
+        return count
+
+    def read(self, file):
+        with gzip.open(file, "rt", encoding="utf-8") as f:
+            return f.read().splitlines()
+
+    def drain(self, backend, batch_size=influxBackup.BATCH_SIZE, retries=DRAIN_RETRIES, retry_wait=RETRY_WAIT):
+        """
+        Write the sealed segments to the storage backend oldest first and delete each one once it
+        is written. Writing a segment again is harmless, the points replace themselves.
+
+        Args:
+            backend: storage.StorageBackend
+            retries: attempts per segment before giving up
+            retry_wait: seconds waited before the first retry, doubled after every failure
+        Returns:
+            count: number of points written
+        Raises:
+            the error of the last attempt when a segment could not be written, the segment is kept
+        """
+        count = 0
+        for _, points, file in self.segments():
+            lines = self.read(file)
+            attempt = 0
+            while True:
+                try:
+                    backend.backupData(lines, batch_size)
+                    break
+                except Exception as err:
+                    attempt += 1
+                    metrics.inc("spool_write_errors_total")
+                    if attempt >= retries:
+                        raise
+                    wait = retry_wait * 2 ** (attempt - 1)
+                    print(f"Writing {os.path.basename(file)} failed ({err}), retrying in {wait} seconds")
+                    time.sleep(wait)
+            os.remove(file)
+            metrics.inc("spool_drained_total", points)
+            count += points
+        return count
+
+class Drainer:
+    """
+    Background thread writing the segments to the storage backend as soon as the stages seal them,
+    so that fetching from Garmin Connect never waits for the storage backend
+    """
+    def __init__(self, spool, backend, batch_size=influxBackup.BATCH_SIZE, retries=DRAIN_RETRIES, retry_wait=RETRY_WAIT):
+        self.spool = spool
+        self.backend = backend
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.points = 0
+        self.error = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.points += self.spool.drain(self.backend, self.batch_size, self.retries, self.retry_wait)
+            except Exception as err:
+                # the segments stay in the spool for the next run, the stages keep spooling meanwhile
+                self.error = err
+                print(f"Storage backend unavailable ({err}), the fetched points stay in {self.spool.path}")
+                return
+            with self.spool.sealed:
+                if self.spool.segments():
+                    # sealed while the previous ones were written
+                    continue
+                if self.stopping:
+                    return
+                self.spool.sealed.wait(timeout=1.0)
+
+    def stop(self):
+        """
+        Wait until every sealed segment is written or the storage backend failed
+
+        Returns:
+            points: number of points written by the drainer
+        """
+        with self.spool.sealed:
+            self.stopping = True
+            self.spool.sealed.notify_all()
+        self.thread.join()
+        return self.points
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show or replay the points waiting in the spool")
+    parser.add_argument("--drain", action="store_true", help="write the spooled points to the storage backend")
+    parser.add_argument("--storage", choices=sorted(storage.BACKENDS), default=storage.STORAGE, help="storage backend the points are written to")
+    args = parser.parse_args()
+    spool = Spool()
+    spool.recover()
+    segments = spool.segments()
+    print(f"{len(segments)} segments, {spool.pending()} points waiting in {spool.path}")
+    if args.drain and segments:
+        backend = storage.getBackend(args.storage)
+        try:
+            print(f"Wrote {spool.drain(backend)} spooled points")
+        finally:
+            backend.close()
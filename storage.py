@@ -0,0 +1,332 @@
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+from tqdm import tqdm
+import flux
+import influxBackup as influxBackup
+import metrics
+import query
+import query_cache
+
+# backend used by main.py and graph_data.py, "influx" or "sqlite"
+STORAGE = os.environ.get("garmin_storage", "influx")
+# single file holding the points with the sqlite backend
+SQLITE_FILE = os.environ.get("garmin_sqlite_file", "garmin.sqlite")
+
+
+class StorageBackend:
+    """
+    Where the backed up points are stored, every backend takes the data of the garmin.py
+    collectors (schema dictionaries or line protocol, or per-day lists of them) and answers
+    the queries of the dashboard with DataFrames indexed by UTC time
+    """
+    name = None
+    # optional day_coverage.Coverage updated with the days of every successful write
+    coverage = None
+    # optional function called with the days of every successful write, like Coverage.add
+    on_write = None
+
+    def key(self):
+        # tells apart the cached query results of different stores
+        raise NotImplementedError
+
+    def _writtenDays(self):
+        # dictionary filled by influxBackup.batches, None when nobody needs the days
+        return None if self.coverage is None and self.on_write is None else {}
+
+    def _written(self, days):
+        if not days:
+            return
+        if self.coverage is not None:
+            self.coverage.add(days)
+        if self.on_write is not None:
+            self.on_write(days)
+
+    def backupData(self, data, batch_size=influxBackup.BATCH_SIZE, dedup=None):
+        """
+        Returns:
+            count: number of points written
+        """
+        raise NotImplementedError
+
+    def get(self, measurements, fields, start, stop, window=None):
+        """
+        Args:
+            window: Flux duration such as "15m" over which the numeric fields are averaged, None for the raw points
+        Returns:
+            df: DataFrame with one column per field and a UTC DatetimeIndex named time
+        """
+        raise NotImplementedError
+
+    def getListOfMeasurements(self):
+        """
+        Returns:
+            data: dictionary of measurement: list of field names
+        """
+        raise NotImplementedError
+
+    def getLastTimestamps(self, measurements):
+        """
+        Returns:
+            last_timestamps: dictionary of measurement: datetime of its latest point
+        """
+        raise NotImplementedError
+
+    def getDays(self, measurements):
+        """
+        Returns:
+            days: dictionary of measurement: numpy array of the days since 1970-01-01 holding at least one point
+        """
+        raise NotImplementedError
+
+    def deleteData(self, startDate, stopDate, measurement):
+        raise NotImplementedError
+
+    def populate_df(self, selected_measurements, selected_fields, start, stop, points=None, lttb_pass=False, cache=None):
+        """
+        Same arguments and result as query.populate_df
+        """
+        def compute():
+            window = None if points is None else query.queryWindow(start, stop, points, lttb_pass)
+            dfs = query.splitFields(self.get(selected_measurements, selected_fields, start, stop, window))
+            if points is not None and lttb_pass:
+                dfs = [query.lttb(df, points) for df in dfs]
+            return dfs
+        return query.cached(cache, selected_measurements, selected_fields, start, stop, (self.key(), points, lttb_pass), compute)
+
+    def close(self):
+        pass
+
+class InfluxBackend(StorageBackend):
+    """
+    The InfluxDB bucket used so far, every method delegates to influxBackup.py and query.py
+    """
+    name = "influx"
+
+    def __init__(self, client=None, bucket=influxBackup.bucket, org=influxBackup.org):
+        self.client = client or influxBackup.getInfuxClient()
+        self.bucket = bucket
+        self.org = org
+
+    def key(self):
+        return (self.name, self.bucket)
+
+    def backupData(self, data, batch_size=influxBackup.BATCH_SIZE, dedup=None):
+        days = self._writtenDays()
+        count = influxBackup.backupData(self.client, data, self.bucket, self.org, batch_size, dedup=dedup, days=days)
+        self._written(days)
+        return count
+
+    def get(self, measurements, fields, start, stop, window=None):
+        return query.queryFrame(self.client, measurements, fields, start, stop, self.bucket, self.org, window)
+
+    def getListOfMeasurements(self):
+        return influxBackup.getListOfMeasurements(self.client, self.bucket, self.org)
+
+    def getLastTimestamps(self, measurements):
+        return influxBackup.getLastTimestamps(self.client, measurements, self.bucket, self.org)
+
+    def getDays(self, measurements):
+        return influxBackup.getDays(self.client, measurements, self.bucket, self.org)
+
+    def deleteData(self, startDate, stopDate, measurement):
+        influxBackup.deleteData(self.client, startDate, stopDate, measurement, self.bucket, self.org)
+        if self.coverage is not None:
+            self.coverage.build([measurement])
+
+    def close(self):
+        self.client.close()
+
+def _unescape(text):
+    return text.replace("\\,", ",").replace("\\=", "=").replace("\\ ", " ").replace('\\"', '"').replace("\\\\", "\\")
+
+def _split(text, separator):
+    # splits on the separators that are neither escaped nor inside a double quoted string
+    parts = []
+    start = 0
+    quoted = False
+    i = 0
+    while i < len(text):
+        character = text[i]
+        if character == "\\":
+            i += 2
+            continue
+        if character == '"':
+            quoted = not quoted
+        elif character == separator and not quoted:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+def _fieldValue(value):
+    if value.startswith('"'):
+        return _unescape(value[1:-1])
+    if value.endswith("i") or value.endswith("u"):
+        return int(value[:-1])
+    if value in ("t", "T", "true", "True", "TRUE"):
+        return True
+    if value in ("f", "F", "false", "False", "FALSE"):
+        return False
+    return float(value)
+
+def parseLine(line):
+    """
+    Parse a line of line protocol
+
+    Returns:
+        measurement: measurement name
+        tags: the tag set as written in the line, "" without tags
+        fields: list of (field name, value)
+        time: timestamp in nanoseconds, None when the line has none
+    """
+    # most lines, e.g. all the heart rate samples, have neither strings nor escapes
+    simple = '"' not in line and "\\" not in line
+    parts = line.split(" ") if simple else _split(line, " ")
+    series, field_set = parts[0], parts[1]
+    timestamp = int(parts[2]) if len(parts) > 2 and parts[2] else None
+    measurement, _, tags = series.partition(",")
+    fields = []
+    for field in (field_set.split(",") if simple else _split(field_set, ",")):
+        key = field.partition("=")[0] if simple else _split(field, "=")[0]
+        fields.append((_unescape(key), _fieldValue(field[len(key) + 1:])))
+    return _unescape(measurement), tags, fields, timestamp
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded single file store, every field value is a row of a table indexed by
+    (measurement, field, time) so that range queries of a field are index range scans.
+    Writing a point again replaces it like in InfluxDB. Tags are kept with the
+    points but are not part of the key.
+    """
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS points (measurement TEXT NOT NULL, field TEXT NOT NULL, "
+                                    "time INTEGER NOT NULL, value, tags TEXT, PRIMARY KEY (measurement, field, time)) WITHOUT ROWID")
+            # measurements and fields, kept up to date on write so that listing them does not scan the points
+            self.connection.execute("CREATE TABLE IF NOT EXISTS catalog (measurement TEXT NOT NULL, field TEXT NOT NULL, "
+                                    "PRIMARY KEY (measurement, field)) WITHOUT ROWID")
+
+    def key(self):
+        return (self.name, os.path.abspath(self.path))
+
+    def backupData(self, data, batch_size=influxBackup.BATCH_SIZE, dedup=None):
+        if data is None:
+            print("No data to back up")
+            return 0
+        print("Backing up data")
+        count = 0
+        written = set()
+        days = self._writtenDays()
+        start_time = time.perf_counter()
+        with tqdm(unit=" points") as progress:
+            for batch in influxBackup.batches(data, batch_size, dedup, days=days):
+                now = time.time_ns()
+                rows = []
+                for line in batch:
+                    measurement, tags, fields, timestamp = parseLine(line)
+                    timestamp = now if timestamp is None else timestamp
+                    rows += [(measurement, field, timestamp, value, tags) for field, value in fields]
+                catalog = {(row[0], row[1]) for row in rows}
+                with metrics.timer("write_seconds", backend=self.name), self.lock, self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?)", rows)
+                    self.connection.executemany("INSERT OR IGNORE INTO catalog VALUES (?, ?)", catalog)
+                metrics.inc("points_written_total", len(batch), backend=self.name)
+                written.update(measurement for measurement, _ in catalog)
+                count += len(batch)
+                progress.update(len(batch))
+        query_cache.markWritten(written)
+        self._written(days)
+        elapsed = time.perf_counter() - start_time
+        print(f"Wrote {count} points in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} points/sec)")
+        return count
+
+    def _select(self, sql, parameters):
+        with self.lock:
+            return pd.read_sql_query(sql, self.connection, params=parameters)
+
+    def get(self, measurements, fields, start, stop, window=None):
+        start = flux.utcTimestamp(start).value
+        stop = flux.utcTimestamp(stop).value
+        selection = (f"measurement IN ({', '.join('?' * len(measurements))}) AND field IN ({', '.join('?' * len(fields))}) "
+                     "AND time >= ? AND time < ?")
+        parameters = list(measurements) + list(fields) + [start, stop]
+        start_time = time.perf_counter()
+        if window is None:
+            rows = self._select(f"SELECT field, time, value FROM points WHERE {selection}", parameters)
+        else:
+            # same epoch aligned windows as aggregateWindow, timed by their start
+            offset = query.windowOffset(window) * 1_000_000_000
+            window = query.windowSeconds(window) * 1_000_000_000
+            rows = self._select(f"SELECT field, (time - {offset}) / {window} * {window} + {offset} AS time, AVG(value) AS value FROM points "
+                                f"WHERE {selection} AND typeof(value) IN ('integer', 'real') GROUP BY field, (time - {offset}) / {window}", parameters)
+        metrics.observe("query_seconds", time.perf_counter() - start_time, backend=self.name)
+        metrics.inc("query_rows_total", len(rows), backend=self.name)
+        if rows.empty:
+            return pd.DataFrame(index=pd.DatetimeIndex([], tz="UTC", name="time"))
+        # fields with the same name in two measurements are merged like the pivot of query.buildQuery
+        rows = rows.drop_duplicates(subset=["time", "field"])
+        df = rows.pivot(index="time", columns="field", values="value").infer_objects()
+        df.columns.name = None
+        df.index = pd.DatetimeIndex(pd.to_datetime(df.index, unit="ns", utc=True), name="time")
+        return df.sort_index()
+
+    def getListOfMeasurements(self):
+        rows = self._select("SELECT measurement, field FROM catalog ORDER BY measurement, field", [])
+        return {measurement: group["field"].tolist() for measurement, group in rows.groupby("measurement")}
+
+    def getLastTimestamps(self, measurements):
+        catalog = self.getListOfMeasurements()
+        last_timestamps = {}
+        for measurement in measurements:
+            # one index lookup per field
+            times = [self._select("SELECT MAX(time) AS time FROM points WHERE measurement = ? AND field = ?", [measurement, field])["time"].iloc[0]
+                     for field in catalog.get(measurement, [])]
+            times = [t for t in times if t is not None and not pd.isna(t)]
+            if times:
+                last_timestamps[measurement] = pd.Timestamp(int(max(times)), unit="ns", tz="UTC").to_pydatetime()
+        return last_timestamps
+
+    def getDays(self, measurements):
+        # one pass over the primary key, the days are computed from the times without reading the values
+        rows = self._select(f"SELECT DISTINCT measurement, time / {influxBackup.DAY} AS day FROM points "
+                            f"WHERE measurement IN ({', '.join('?' * len(measurements))})", list(measurements))
+        return {measurement: group["day"].to_numpy() for measurement, group in rows.groupby("measurement")}
+
+    def deleteData(self, startDate, stopDate, measurement):
+        # both ends are included like the delete API of InfluxDB
+        start = flux.utcTimestamp(startDate).value
+        stop = flux.utcTimestamp(stopDate).value
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM points WHERE measurement = ? AND time >= ? AND time <= ?", (measurement, start, stop))
+            self.connection.execute("DELETE FROM catalog WHERE measurement = ? AND NOT EXISTS "
+                                    "(SELECT 1 FROM points WHERE points.measurement = catalog.measurement AND points.field = catalog.field)", (measurement,))
+        query_cache.markWritten([measurement])
+        if self.coverage is not None:
+            self.coverage.build([measurement])
+        print("Data deleted")
+
+    def close(self):
+        self.connection.close()
+
+BACKENDS = {"influx": InfluxBackend, "sqlite": SQLiteBackend}
+
+def getBackend(name=STORAGE, **kwargs):
+    """
+    Args:
+        name: one of the keys of BACKENDS
+        kwargs: passed to the constructor of the backend
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {name}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](**kwargs)